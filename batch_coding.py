@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from memory_coding import code_memory
+from prompting import save_generation_log
+from packed_coding import code_packed_memories
+from constants import *
+
+
+def iter_coded_items(items, message_history: list[dict[str, str]],
+                     model_parameters, user=None, max_workers=BATCH_MAX_WORKERS_DEFAULT,
+                     return_exceptions=False, pack_size=PACKED_MEMORIES_DEFAULT, log_sink=None, **kwargs):
+    """
+    Code memories with at most `max_workers` requests to the model service at once.
+    `items` can be any (lazy) iterable of (key, memory): it is only read as far as needed to keep
+    the workers busy, so coding starts with the first memories while the rest are still being read.
+    The system prompt, client and user are resolved by the caller (see coder.Coder),
+    so the workers only do the network round-trips.
+    :param return_exceptions: if True, a failed memory is yielded with its exception instead of
+                              raising it (and aborting all the others)
+    :param pack_size: number of memories to code in a single request (see packed_coding),
+                      NaCCS memories are never packed, since they are only scored (see coherence_scoring)
+    :param log_sink: where the generation logs of the packed requests themselves are saved (from the calling
+                     thread), the process-wide sink by default (the memories' logs are yielded)
+    :return: generator of (key, memory, result, generation_log, error), in order of completion
+    """
+    max_workers = max(1, max_workers)
+    if model_parameters[3] == NARRATIVE_COHERENCE:  # a stop sequence would end the packed output at its first total
+        pack_size = 1
+    code_items = code_packed_memories if pack_size > 1 else _code_single_memory
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    try:
+        for pack in _iter_packs(items, max(1, pack_size)):
+            futures[executor.submit(code_items, pack, message_history, model_parameters, user, **kwargs)] = pack
+            if len(futures) >= max_workers * BATCH_IN_FLIGHT_FACTOR:
+                yield from _pop_completed(futures, return_exceptions, log_sink)
+        while futures:
+            yield from _pop_completed(futures, return_exceptions, log_sink)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)  # don't keep paying after a failure
+
+
+def _iter_packs(items, pack_size):
+    pack = []
+    for item in items:
+        pack.append(item)
+        if len(pack) == pack_size:
+            yield pack
+            pack = []
+    if pack:
+        yield pack
+
+
+def _code_single_memory(items, message_history, model_parameters, user, **kwargs):
+    (key, memory), = items
+    result, _, log = code_memory(memory, message_history, model_parameters=model_parameters, user=user, **kwargs)
+    return [(key, memory, result, log, None)], []
+
+
+def _pop_completed(futures, return_exceptions, log_sink):
+    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+    for future in done:
+        pack = futures.pop(future)
+        error = future.exception()
+        if error is not None:
+            if not return_exceptions:
+                raise error
+            for key, memory in pack:
+                yield key, memory, None, None, error
+            continue
+        coded_items, request_logs = future.result()
+        save_generation_log(multiple_generation_logs=request_logs, log_sink=log_sink)
+        for key, memory, result, log, item_error in coded_items:
+            if item_error is not None and not return_exceptions:
+                raise item_error
+            yield key, memory, result, log, item_error
+
+
+def iter_coded_memories(memories, message_history: list[dict[str, str]],
+                        model_parameters, user=None, max_workers=BATCH_MAX_WORKERS_DEFAULT,
+                        **kwargs):
+    """
+    :return: generator of (index, memory, result, generation_log), in order of completion
+             (see iter_coded_items)
+    """
+    for i, memory, result, log, _ in iter_coded_items(enumerate(memories), message_history,
+                                                      model_parameters, user, max_workers, **kwargs):
+        yield i, memory, result, log
+
+
+def code_memories(memories, message_history: list[dict[str, str]],
+                  model_parameters, user=None, max_workers=BATCH_MAX_WORKERS_DEFAULT,
+                  progress_callback=None, **kwargs):
+    """
+    Code many memories concurrently (see iter_coded_memories)
+    :param progress_callback: called as progress_callback(num_coded, num_memories) from the
+                              calling thread every time a memory is coded (in any order),
+                              num_memories is None if `memories` has no length (lazy iterable)
+    :return: memories, results and generation logs, all in the same order as the input memories
+    """
+    num_memories = len(memories) if hasattr(memories, "__len__") else None
+    coded = {}
+    for i, memory, result, log in iter_coded_memories(memories, message_history, model_parameters,
+                                                      user, max_workers, **kwargs):
+        coded[i] = (memory, result, log)
+        if progress_callback is not None:
+            progress_callback(len(coded), num_memories)
+    ordered = [coded[i] for i in range(len(coded))]
+    return [memory for memory, _, _ in ordered], [result for _, result, _ in ordered], \
+        [log for _, _, log in ordered]
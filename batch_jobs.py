@@ -0,0 +1,187 @@
+import time
+import hashlib
+import sqlite3
+import threading
+
+from batch_coding import iter_coded_items
+from prompting import save_generation_log
+from coded_results import is_valid_coded_result, MalformedResultError
+from process_wide import process_wide
+from constants import *
+
+
+class BatchJobCheckpoint:
+    """
+    Persistent record of the results already coded by each batch job,
+    keyed by the job ID and the memory's row in the input.
+    Only the results are kept: the memories are in the job's input, and the logs in the log sink.
+    """
+    def __init__(self, path=BATCH_JOBS_CHECKPOINT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS coded_results (job_id TEXT, row_index INTEGER, "
+                                    "result TEXT, PRIMARY KEY (job_id, row_index))")
+            # checkpoints of older versions also kept every row's memory and generation log
+            if self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                       "AND name = 'coded_rows'").fetchone():
+                self.connection.execute("INSERT OR IGNORE INTO coded_results "
+                                        "SELECT job_id, row_index, result FROM coded_rows")
+                self.connection.execute("DROP TABLE coded_rows")
+
+    def count(self, job_id):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM coded_results WHERE job_id = ?",
+                                           (job_id,)).fetchone()[0]
+
+    def iter_results(self, job_id, page_size=BATCH_JOB_CHECKPOINT_PAGE_SIZE):
+        """
+        :return: iterator of (row_index, result) of the rows the job already coded, in the input order,
+                 read a page at a time (so rows saved while iterating may be included)
+        """
+        last_row_index = -1
+        while True:
+            with self.lock:
+                rows = self.connection.execute("SELECT row_index, result FROM coded_results "
+                                               "WHERE job_id = ? AND row_index > ? ORDER BY row_index LIMIT ?",
+                                               (job_id, last_row_index, page_size)).fetchall()
+            yield from rows
+            if len(rows) < page_size:
+                return
+            last_row_index = rows[-1][0]
+
+    def save(self, job_id, row_index, result):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO coded_results VALUES (?, ?, ?)",
+                                    (job_id, row_index, result))
+
+    def clear(self, job_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM coded_results WHERE job_id = ?", (job_id,))
+
+
+def get_batch_job_id(input_content: bytes, model_parameters, system_prompt):
+    """
+    The same input coded with the same configuration is the same job,
+    so re-running it (e.g. after a browser refresh) resumes it
+    """
+    _, service, base_llm, coding_task = model_parameters
+    job_hash = hashlib.sha256(input_content)
+    for part in (service, base_llm, coding_task, system_prompt):
+        job_hash.update(b"\0" + part.encode("utf-8"))
+    return job_hash.hexdigest()[:BATCH_JOB_ID_LENGTH]
+
+
+def run_batch_job(job_id, memories, message_history: list[dict[str, str]],
+                  model_parameters, user, checkpoint=None, max_row_retries=BATCH_JOB_MAX_ROW_RETRIES,
+                  progress_callback=None, row_callback=None, log_sink=None, keep_results=True, **kwargs):
+    """
+    Codes the memories the job hasn't coded yet, saving each one (and its generation log)
+    as soon as it is coded. Memories that fail, or whose result is malformed, are retried individually,
+    without stopping the others.
+    :param progress_callback: called as progress_callback(num_coded, num_memories), where num_coded
+                              includes rows coded by previous runs of the job and num_memories is
+                              None until all the memories were read
+    :param row_callback: called as row_callback(row_index, memory, result) from the calling thread
+                         for every coded row (including those coded by previous runs), in any order
+    :param log_sink: where the generation logs are saved, the process-wide sink by default
+    :param keep_results: if False, the coded rows are only passed to row_callback (and saved in the checkpoint),
+                         so the memory it takes doesn't grow with the number of memories
+    :return: memories, results and generation logs in the input order (result and log are None for
+             rows that failed, or the last malformed ones, and the log is None for rows coded by previous
+             runs of the job), and a {row_index: error} dict of the rows
+             that failed every retry. Without keep_results, the memories, results and logs are
+             {row_index: value} dicts of only the failed rows.
+    """
+    checkpoint = checkpoint or get_batch_job_checkpoint()
+    num_coded = [checkpoint.count(job_id)]
+    coded_rows = {}  # {row_index: (result, log)}, only with keep_results
+    read_memories = [] if keep_results else {}  # without keep_results, only the memories that aren't coded yet
+    num_read_memories = [0]
+    num_memories = len(memories) if hasattr(memories, "__len__") else None
+
+    def pending_rows():
+        # the rows coded by previous runs are read along with the memories, both in the input order
+        previous_results = checkpoint.iter_results(job_id)
+        previous_row_index, previous_result = next(previous_results, (None, None))
+        for row_index, memory in enumerate(memories):
+            num_read_memories[0] += 1
+            if keep_results:
+                read_memories.append(memory)
+            while previous_row_index is not None and previous_row_index < row_index:  # e.g. saved by this run
+                previous_row_index, previous_result = next(previous_results, (None, None))
+            if previous_row_index != row_index:
+                if not keep_results:
+                    read_memories[row_index] = memory
+                yield row_index, memory
+                continue
+            if keep_results:
+                coded_rows[row_index] = (previous_result, None)
+            if row_callback is not None:
+                row_callback(row_index, memory, previous_result)
+
+    def report_progress():
+        if progress_callback is not None:
+            progress_callback(num_coded[0], num_memories)
+
+    coding_task = model_parameters[3]
+    # malformed results are regenerated with some sampling, to get a different output than the cached one
+    regeneration_kwargs = dict(kwargs)
+    regeneration_kwargs[TEMPERATURE_PARAM] = max(kwargs.get(TEMPERATURE_PARAM, DEFAULT_TEMPERATURE),
+                                                 REGENERATION_TEMPERATURE)
+    malformed_rows = {}  # the last result and log of rows with a malformed result
+    report_progress()
+    rows_to_code, failed_rows = [(pending_rows(), kwargs)], {}
+    for retry in range(max_row_retries + 1):
+        if retry > 0:
+            time.sleep(BATCH_JOB_RETRY_DELAY_SECONDS * retry)
+            rows_to_code = [([(row_index, read_memories[row_index]) for row_index in failed_rows
+                              if row_index not in malformed_rows], kwargs),
+                            ([(row_index, read_memories[row_index]) for row_index in failed_rows
+                              if row_index in malformed_rows], regeneration_kwargs)]
+            failed_rows = {}
+        for rows, rows_kwargs in rows_to_code:
+            for row_index, memory, result, log, error in iter_coded_items(rows, message_history, model_parameters,
+                                                                          user, return_exceptions=True,
+                                                                          log_sink=log_sink, **rows_kwargs):
+                if error is not None:
+                    failed_rows[row_index] = error
+                    continue
+                save_generation_log(single_generation_log=log, log_sink=log_sink)
+                if not is_valid_coded_result(memory, result, coding_task):
+                    failed_rows[row_index] = MalformedResultError(f"The model generated a malformed result: {result!r}")
+                    malformed_rows[row_index] = (result, log)
+                    continue
+                malformed_rows.pop(row_index, None)
+                checkpoint.save(job_id, row_index, result)
+                num_coded[0] += 1
+                if keep_results:
+                    coded_rows[row_index] = (result, log)
+                else:
+                    del read_memories[row_index]
+                if row_callback is not None:
+                    row_callback(row_index, memory, result)
+                report_progress()
+        num_memories = num_read_memories[0]  # all the memories were read by the end of the first pass
+        if not failed_rows:
+            break
+    report_progress()
+    if not keep_results:  # only the failed rows are left in read_memories
+        failed_results = {row_index: malformed_rows.get(row_index, (None, None)) for row_index in read_memories}
+        return read_memories, {row_index: result for row_index, (result, _) in failed_results.items()}, \
+            {row_index: log for row_index, (_, log) in failed_results.items()}, failed_rows
+    results, logs = [], []
+    for row_index in range(len(read_memories)):
+        if row_index in coded_rows:
+            result, log = coded_rows[row_index]
+        else:  # the malformed result is still better than nothing
+            result, log = malformed_rows.get(row_index, (None, None))
+        results.append(result)
+        logs.append(log)
+    return read_memories, results, logs, failed_rows
+
+
+@process_wide
+def get_batch_job_checkpoint():
+    return BatchJobCheckpoint()
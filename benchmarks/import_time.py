@@ -0,0 +1,74 @@
+"""
+Guards the cold start of the app (importing main is all the welcome page needs) and of the CLI,
+by importing them in a fresh interpreter with `python -X importtime`.
+Fails if a module that should only be imported on demand (provider SDKs, pandas, file format libraries,
+the gsheets connector) is imported at startup, or if an import takes longer than its budget.
+Example:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --budget main=800 --budget cli=150 --repeat 5
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY_MODULES = ["openai", "huggingface_hub", "together", "pandas", "numpy", "openpyxl", "xlsxwriter", "pyarrow",
+                "streamlit_gsheets", "transformers", "torch"]
+DEFAULT_BUDGETS_MS = {"main": 1500, "cli": 300}
+NUM_SLOWEST_IMPORTS = 10
+
+
+def measure_import(module, python=sys.executable):
+    """
+    :return: {imported module: (self microseconds, cumulative microseconds)} of importing the module
+             in a fresh interpreter
+    """
+    process = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"], cwd=REPO_PATH,
+                             capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{process.stderr}")
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.setdefault(name.strip(), (int(self_us), int(cumulative_us)))
+    return imports
+
+
+def parse_budget(budget):
+    module, milliseconds = budget.split("=")
+    return module, float(milliseconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=parse_budget, action="append", default=[],
+                        help="module=milliseconds, the maximal time to import the module "
+                             f"(defaults: {', '.join(f'{m}={ms}' for m, ms in DEFAULT_BUDGETS_MS.items())})")
+    parser.add_argument("--repeat", type=int, default=3, help="the best of this many imports is compared to the budget")
+    args = parser.parse_args()
+    budgets = {**DEFAULT_BUDGETS_MS, **dict(args.budget)}
+    failures = []
+    for module, budget_ms in budgets.items():
+        measurements = [measure_import(module) for _ in range(args.repeat)]
+        best = min(measurements, key=lambda imports: imports[module][1])
+        import_ms = best[module][1] / 1000
+        print(f"{module}: {import_ms:.0f}ms (budget {budget_ms:.0f}ms), slowest imports:")
+        top_level = {name: times for name, times in best.items() if "." not in name and name != module}
+        for name, (_, cumulative_us) in sorted(top_level.items(), key=lambda item: -item[1][1])[:NUM_SLOWEST_IMPORTS]:
+            print(f"    {name:<30} {cumulative_us / 1000:>8.1f}ms")
+        if import_ms > budget_ms:
+            failures.append(f"importing {module} took {import_ms:.0f}ms, more than its {budget_ms:.0f}ms budget")
+        eager_modules = [name for name in LAZY_MODULES if name in best]
+        if eager_modules:
+            failures.append(f"importing {module} also imports {', '.join(eager_modules)}, "
+                            f"which should be imported only when used")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
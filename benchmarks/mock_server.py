@@ -0,0 +1,212 @@
+"""
+A local OpenAI-compatible chat completions server that "codes" memories without a model,
+with configurable latency, token rate, truncation and error injection.
+Run it alone with: python benchmarks/mock_server.py --port 8000
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PACKED_MEMORY_PATTERN = re.compile(r"^### MEMORY (\d+)\n(.*?)\n### END \1$", re.MULTILINE | re.DOTALL)
+SLV_CODE = "_int_neu_"
+COH_RESULT = "Context: 2\nChronology: 1\nTheme: 3\nTotal: 6"
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_TOKENS = 4
+
+
+class MockModelConfig:
+    def __init__(self, latency_seconds=0.05, tokens_per_second=500.0, truncation_rate=0.0, error_rate=0.0,
+                 error_status_code=429, retry_after_seconds=0.1, coherence=False, seed=None):
+        """
+        :param latency_seconds: time until the first token
+        :param tokens_per_second: generation speed after the first token (0 for instant)
+        :param truncation_rate: probability of cutting a (non continuation) output in the middle,
+                                with finish_reason "length"
+        :param error_rate: probability of failing a request with error_status_code
+        :param retry_after_seconds: sent as the Retry-After header of errors (None to not send it)
+        :param coherence: whether to answer with a NaCCS result instead of an SLV coded memory
+        """
+        self.latency_seconds = latency_seconds
+        self.tokens_per_second = tokens_per_second
+        self.truncation_rate = truncation_rate
+        self.error_rate = error_rate
+        self.error_status_code = error_status_code
+        self.retry_after_seconds = retry_after_seconds
+        self.coherence = coherence
+        self.random = random.Random(seed)
+
+
+class MockModelStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "errors": 0, "truncations": 0, "continuations": 0, "completion_tokens": 0}
+
+    def increment(self, **increments):
+        with self.lock:
+            for count, increment in increments.items():
+                self.counts[count] += increment
+
+    def get(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+def code_memory(memory, coherence):
+    return COH_RESULT if coherence else f"{memory.strip()} {SLV_CODE}"
+
+
+def get_full_output(user_message, coherence):
+    packed_memories = PACKED_MEMORY_PATTERN.findall(user_message)
+    if not packed_memories:
+        return code_memory(user_message, coherence)
+    return "\n".join(f"### RESULT {i}\n{code_memory(memory, coherence)}\n### END {i}" for i, memory in packed_memories)
+
+
+def get_output(messages, config: MockModelConfig):
+    """
+    :return: output, finish_reason and whether the request continues a truncated output
+    """
+    # a continuation request ends with the truncated output and an instruction to continue it
+    if len(messages) >= 3 and messages[-2]["role"] == "assistant":
+        full_output = get_full_output(messages[-3]["content"], config.coherence)
+        return full_output[len(messages[-2]["content"]):], "stop", True
+    full_output = get_full_output(messages[-1]["content"], config.coherence)
+    if config.random.random() < config.truncation_rate:
+        return full_output[:len(full_output) // 2], "length", False
+    return full_output, "stop", False
+
+
+def apply_stop_sequences(output, stop):
+    """
+    :return: the output up to the first of the stop sequences (which, like the real services, isn't returned)
+    """
+    for sequence in [stop] if isinstance(stop, str) else stop or []:
+        output = output.split(sequence, 1)[0]
+    return output
+
+
+class MockModelHandler(BaseHTTPRequestHandler):
+    server_version = "MockModel/1.0"
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+
+    def log_message(self, format, *args):
+        pass  # don't flood the benchmark's output
+
+    def send_json(self, status_code, body, headers=None):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        config, stats = self.server.config, self.server.stats
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        stats.increment(requests=1)
+        if config.random.random() < config.error_rate:
+            stats.increment(errors=1)
+            headers = {} if config.retry_after_seconds is None else {"Retry-After": str(config.retry_after_seconds)}
+            self.send_json(config.error_status_code, {"error": {"message": "Injected error", "type": "mock_error"}},
+                           headers)
+            return
+        output, finish_reason, is_continuation = get_output(request["messages"], config)
+        output = apply_stop_sequences(output, request.get("stop"))
+        completion_tokens = max(1, len(output) // CHARS_PER_TOKEN)
+        stats.increment(truncations=int(finish_reason == "length"), continuations=int(is_continuation),
+                        completion_tokens=completion_tokens)
+        time.sleep(config.latency_seconds)
+        if request.get("stream"):
+            self.stream_output(request["model"], output, finish_reason, config)
+            return
+        if config.tokens_per_second:
+            time.sleep(completion_tokens / config.tokens_per_second)
+        prompt_tokens = sum(len(str(message["content"])) for message in request["messages"]) // CHARS_PER_TOKEN
+        self.send_json(200, {
+            "id": "mock-completion", "object": "chat.completion", "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": output},
+                         "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}})
+
+    def stream_output(self, model, output, finish_reason, config: MockModelConfig):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")  # the end of the stream is the end of the response
+        self.end_headers()
+        chunk_length = STREAM_CHUNK_TOKENS * CHARS_PER_TOKEN
+        chunks = [output[i:i + chunk_length] for i in range(0, len(output), chunk_length)]
+        for i, content in enumerate(chunks):
+            if config.tokens_per_second:
+                time.sleep(STREAM_CHUNK_TOKENS / config.tokens_per_second)
+            self.write_event({"id": "mock-completion", "object": "chat.completion.chunk", "created": int(time.time()),
+                              "model": model, "choices": [{"index": 0, "delta": {"content": content},
+                                                           "finish_reason": finish_reason if i == len(chunks) - 1 else None}]})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def write_event(self, body):
+        self.wfile.write(f"data: {json.dumps(body)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+class MockModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, config: MockModelConfig = None, host="127.0.0.1", port=0):
+        """
+        :param port: 0 to pick a free port (see base_url)
+        """
+        super().__init__((host, port), MockModelHandler)
+        self.config = config or MockModelConfig()
+        self.stats = MockModelStats()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds until the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--truncation-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status-code", type=int, default=429)
+    parser.add_argument("--coherence", action="store_true", help="answer with NaCCS results")
+    args = parser.parse_args()
+    config = MockModelConfig(args.latency, args.tokens_per_second, args.truncation_rate, args.error_rate,
+                             args.error_status_code, coherence=args.coherence)
+    server = MockModelServer(config, port=args.port)
+    print(f"Mock model server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
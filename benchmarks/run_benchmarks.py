@@ -0,0 +1,231 @@
+"""
+Measures the throughput and latency of the coding pipeline against a local mock model server
+(see mock_server.py), without streamlit and without spending API quota.
+Example:
+    python benchmarks/run_benchmarks.py --concurrency 1 8 32 --sizes 100 1000 --save-baseline baseline.json
+    python benchmarks/run_benchmarks.py --concurrency 1 8 32 --sizes 100 1000 --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_server import MockModelConfig, MockModelServer
+from clients import create_client
+from prompting import get_system_prompt, code_text, save_generation_log, raw_generation
+from generation_logging import BufferedLogSink, JsonlLogSink, set_generation_log_sink
+from scheduling import RequestScheduler, set_scheduler
+from batch_jobs import BatchJobCheckpoint, run_batch_job
+from exporting import create_results_writer
+from constants import *
+
+BENCHMARK_USER = "benchmark"
+BENCHMARK_LLM = "mock-model"
+SINGLE_SCENARIO = "single"  # memories coded one by one, like the single memory page
+BATCH_SCENARIO = "batch"  # like the multiple memories page
+SAMPLE_MEMORIES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    "fictional_memories_to_test.txt")
+
+
+def get_sample_memories(num_memories):
+    with open(SAMPLE_MEMORIES_PATH, encoding="utf-8") as f:
+        sample_memories = [line.strip() for line in f if line.strip()]
+    return [f"{sample_memories[i % len(sample_memories)]} ({i})" for i in range(num_memories)]
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024  # bytes on macOS, KB on linux
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(percentile / 100 * (len(values) - 1)))]
+
+
+class TimedGeneration:
+    """
+    A generation function that records the latency of every request
+    """
+    def __init__(self, generation_func=raw_generation):
+        self.generation_func = generation_func
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def __call__(self, client, base_llm, messages, generation_kwargs):
+        start = time.perf_counter()
+        try:
+            return self.generation_func(client, base_llm, messages, generation_kwargs)
+        finally:
+            with self.lock:
+                self.latencies.append(time.perf_counter() - start)
+
+
+def run_single_scenario(memories, message_history, model_parameters, timed_generation, **_):
+    failed_rows = 0
+    for memory in memories:
+        try:
+            _, _, log = code_text(memory, message_history, use_cache=False, generation_func=timed_generation,
+                                  model_parameters=model_parameters, user=BENCHMARK_USER)
+        except Exception:
+            failed_rows += 1
+        else:
+            save_generation_log(single_generation_log=log)
+    return failed_rows
+
+
+def run_batch_scenario(memories, message_history, model_parameters, timed_generation, concurrency,
+                       checkpoint, output_format):
+    results_writer = create_results_writer(output_format, model_parameters[3])
+    _, results, _, failed_rows = run_batch_job(uuid.uuid4().hex, memories, message_history, model_parameters,
+                                               BENCHMARK_USER, checkpoint, row_callback=results_writer.write,
+                                               max_workers=concurrency, use_cache=False,
+                                               generation_func=timed_generation)
+    os.remove(results_writer.finish(memories, results))
+    return len(failed_rows)
+
+
+def run_benchmark(scenario, num_memories, concurrency, server, model_parameters, checkpoint, args):
+    service = model_parameters[1]
+    scheduler = RequestScheduler(args.requests_per_minute, args.tokens_per_minute)
+    set_scheduler(service, scheduler)  # fresh limits and stats for every run
+    message_history = [{"role": "system", "content": get_system_prompt(DIRECT_CODING_TASK, model_parameters[3])}]
+    memories = get_sample_memories(num_memories)
+    timed_generation = TimedGeneration()
+    server_stats_before = server.stats.get()
+    start = time.perf_counter()
+    run_scenario = run_single_scenario if scenario == SINGLE_SCENARIO else run_batch_scenario
+    failed_rows = run_scenario(memories, message_history, model_parameters, timed_generation,
+                               concurrency=concurrency, checkpoint=checkpoint, output_format=args.output_format)
+    seconds = time.perf_counter() - start
+    server_stats = {count: value - server_stats_before[count] for count, value in server.stats.get().items()}
+    scheduler_stats = scheduler.get_stats()
+    latencies_ms = [latency * 1000 for latency in timed_generation.latencies]
+    return {
+        "scenario": scenario, "num_memories": num_memories, "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "memories_per_second": round(num_memories / seconds, 3),
+        "latency_p50_ms": get_percentile(latencies_ms, 50),
+        "latency_p95_ms": get_percentile(latencies_ms, 95),
+        "latency_p99_ms": get_percentile(latencies_ms, 99),
+        "requests": scheduler_stats["requests"],
+        "retries": scheduler_stats["retries"],
+        "rate_limited": scheduler_stats["rate_limited"],
+        "continuations": server_stats["continuations"],
+        "failed_rows": failed_rows,
+        "peak_rss_mb": get_peak_rss_mb(),  # of the whole process, so it never decreases between runs
+    }
+
+
+def get_result_key(result):
+    return result["scenario"], result["num_memories"], result["concurrency"]
+
+
+def find_regressions(results, baseline_results, tolerance):
+    """
+    :return: descriptions of the runs that are slower than their baseline run by more than the tolerance
+    """
+    baseline_by_key = {get_result_key(result): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        baseline = baseline_by_key.get(get_result_key(result))
+        if baseline is None:
+            continue
+        if result["memories_per_second"] < baseline["memories_per_second"] * (1 - tolerance):
+            regressions.append(f"{get_result_key(result)}: {result['memories_per_second']} memories/s "
+                               f"(baseline {baseline['memories_per_second']})")
+        if (result["latency_p95_ms"] is not None and baseline["latency_p95_ms"] is not None
+                and result["latency_p95_ms"] > baseline["latency_p95_ms"] * (1 + tolerance)):
+            regressions.append(f"{get_result_key(result)}: p95 latency {result['latency_p95_ms']:.1f}ms "
+                               f"(baseline {baseline['latency_p95_ms']:.1f}ms)")
+    return regressions
+
+
+def print_result(result):
+    print(f"{result['scenario']:>6} | {result['num_memories']:>6} memories | concurrency {result['concurrency']:>3} | "
+          f"{result['memories_per_second']:>8.2f} memories/s | p50/p95/p99 {result['latency_p50_ms'] or 0:.0f}/"
+          f"{result['latency_p95_ms'] or 0:.0f}/{result['latency_p99_ms'] or 0:.0f}ms | "
+          f"retries {result['retries']} | continuations {result['continuations']} | "
+          f"failed {result['failed_rows']} | peak RSS {result['peak_rss_mb'] or 0:.0f}MB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=[SINGLE_SCENARIO, BATCH_SCENARIO],
+                        default=[SINGLE_SCENARIO, BATCH_SCENARIO])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32],
+                        help="batch workers (the single scenario always runs with 1)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100], help="numbers of memories to code")
+    parser.add_argument("--coding-task", choices=ALL_CODING_TASKS, default=SEGMENT_LOCUS_VALENCE)
+    parser.add_argument("--output-format", choices=["TXT", "CSV", "CSV (gzip)", "XLSX", "Parquet"], default="CSV")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock seconds until the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0, help="mock generation speed")
+    parser.add_argument("--truncation-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.1, help="mock Retry-After of injected errors")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests-per-minute", type=float, default=10 ** 6)
+    parser.add_argument("--tokens-per-minute", type=float, default=10 ** 9)
+    parser.add_argument("--output", help="path to save the results as JSON")
+    parser.add_argument("--save-baseline", help="path to save the results as the baseline")
+    parser.add_argument("--baseline", help="path of a baseline to compare the results to")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown that counts as a regression")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = MockModelConfig(args.latency, args.tokens_per_second, args.truncation_rate, args.error_rate,
+                             retry_after_seconds=args.retry_after, coherence=args.coding_task == NARRATIVE_COHERENCE,
+                             seed=args.seed)
+    server = MockModelServer(config).start()
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    set_generation_log_sink(BufferedLogSink(JsonlLogSink(os.path.join(work_dir, "generation_log.jsonl"))))
+    checkpoint = BatchJobCheckpoint(os.path.join(work_dir, "batch_jobs.sqlite"))
+    model_parameters = (create_client(FREE_SERVICE, "mock", server.base_url), FREE_SERVICE, BENCHMARK_LLM,
+                        args.coding_task)
+    results = []
+    try:
+        for scenario in args.scenarios:
+            for num_memories in args.sizes:
+                for concurrency in ([1] if scenario == SINGLE_SCENARIO else args.concurrency):
+                    result = run_benchmark(scenario, num_memories, concurrency, server, model_parameters,
+                                           checkpoint, args)
+                    print_result(result)
+                    results.append(result)
+    finally:
+        server.stop()
+    report = {"environment": {"python": platform.python_version(), "platform": platform.platform(),
+                              "cpu_count": os.cpu_count()},
+              "config": {key: value for key, value in vars(args).items()
+                         if key not in ("output", "save_baseline", "baseline")},
+              "results": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions compared to the baseline")
+
+
+if __name__ == "__main__":
+    main()
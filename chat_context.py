@@ -0,0 +1,92 @@
+import json
+import uuid
+from constants import *
+
+
+def estimate_tokens(message):
+    return len(message["content"]) // ESTIMATED_CHARS_PER_TOKEN + CHAT_MESSAGE_OVERHEAD_TOKENS
+
+
+class ChatContext:
+    """
+    A conversation, and the part of it that is sent to the model: the system prompt, a summary of the older
+    turns and the most recent turns that fit in the token budget.
+    Older turns are summarized in chunks (once the history outgrows the budget, until it only takes
+    CHAT_HISTORY_KEEP_FRACTION of it), so a summary isn't needed on every turn.
+    Only the messages that weren't logged yet are logged with every turn, under the conversation's ID.
+    """
+    def __init__(self, system_prompt, max_history_tokens=CHAT_HISTORY_MAX_TOKENS):
+        self.conversation_id = uuid.uuid4().hex
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.messages = []  # all the turns, for display
+        self.max_history_tokens = max_history_tokens
+        self.summary = ""
+        self.num_summarized = 0  # the first messages, whose content is only sent as the summary
+        self.num_logged = 0  # including the system message
+
+    def add_message(self, role, content):
+        self.messages.append({"role": role, "content": content})
+
+    def add_answer(self, content):
+        # the answer is logged as the output of the turn, so it is never logged again as an input
+        self.add_message("assistant", content)
+        if self.num_logged == len(self.messages):
+            self.num_logged += 1
+
+    def get_history_tokens(self, start=None):
+        return sum(map(estimate_tokens, self.messages[self.num_summarized if start is None else start:]))
+
+    def needs_summary(self):
+        return self.get_history_tokens() > self.max_history_tokens
+
+    def get_summary_end(self):
+        """
+        :return: the index of the first message to keep as is, the beginning of a user turn
+                 after which the history takes at most CHAT_HISTORY_KEEP_FRACTION of the budget
+        """
+        user_turns = [i for i in range(self.num_summarized + 1, len(self.messages))
+                      if self.messages[i]["role"] == "user"]
+        for i in user_turns:
+            if self.get_history_tokens(i) <= self.max_history_tokens * CHAT_HISTORY_KEEP_FRACTION:
+                return i
+        return user_turns[-1] if user_turns else self.num_summarized
+
+    def get_summary_messages(self, summary_end):
+        transcript = "\n\n".join(f"{message['role'].upper()}: {message['content']}"
+                                 for message in self.messages[self.num_summarized:summary_end])
+        previous_summary = f"SUMMARY OF THE EARLIER CONVERSATION:\n{self.summary}\n\n" if self.summary else ""
+        return [{"role": "system", "content": CHAT_SUMMARY_INSTRUCTION},
+                {"role": "user", "content": f"{previous_summary}CONVERSATION:\n{transcript}"}]
+
+    def set_summary(self, summary, summary_end):
+        self.summary = summary
+        self.num_summarized = summary_end
+
+    def get_request_messages(self):
+        """
+        The system prompt (with the summary) and the latest turns, dropping the oldest ones while they
+        don't fit in the budget (in case summarizing failed), but never the last message
+        """
+        system_message = self.system_message
+        if self.summary:
+            system_message = {"role": "system",
+                              "content": f"{self.system_message['content']}\n\n{CHAT_SUMMARY_TITLE}\n{self.summary}"}
+        start = self.num_summarized
+        while start < len(self.messages) - 1 and self.get_history_tokens(start) > self.max_history_tokens:
+            start += 1
+        return [system_message] + self.messages[start:]
+
+    def get_unlogged_messages(self):
+        """
+        :return: the messages that weren't logged yet (the system prompt only with the first turn),
+                 and marks them as logged
+        """
+        all_messages = [self.system_message] + self.messages
+        unlogged_messages = all_messages[self.num_logged:]
+        self.num_logged = len(all_messages)
+        return unlogged_messages
+
+    @staticmethod
+    def get_summary_log_input(summary_start, summary_end):
+        # the summarized messages were already logged, so only their indices are
+        return json.dumps({"summarized_messages": [summary_start, summary_end]})
@@ -0,0 +1,217 @@
+"""
+Codes a corpus of memories from the command line, without the app (see coder.Coder).
+Examples:
+    python cli.py code memories.csv -o results.csv --workers 16
+    cat memories.txt | python cli.py code - -o results.parquet --coding-task Narrative-Coherence
+    python cli.py code memories.csv -o results_0.csv --shard 0/4  # on each of 4 machines, 0/4 to 3/4
+    python cli.py merge -o results.csv results_0.csv results_1.csv results_2.csv results_3.csv
+"""
+import io
+import os
+import sys
+import csv
+import gzip
+import uuid
+import hashlib
+import argparse
+from itertools import islice
+
+from coder import Coder
+from instrumentation import set_trace_path
+from clients import create_client
+from batch_jobs import get_batch_job_checkpoint
+from generation_logging import BufferedLogSink, create_generation_log_sink
+from ingestion import iter_text_memories, iter_csv_memories, iter_xlsx_memories
+from exporting import RESULTS_WRITERS, create_results_writer, get_output_format
+from constants import *
+
+INPUT_READERS = {"TXT": iter_text_memories, "CSV": iter_csv_memories, "XLSX": iter_xlsx_memories}
+STDIN_PATH = "-"
+INPUT_HASH_CHUNK_SIZE = 1024 ** 2
+
+
+def parse_shard(shard):
+    """
+    :param shard: "i/N", the 0-based index of the shard and the number of shards
+    """
+    try:
+        index, num_shards = map(int, shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, not {shard!r}")
+    if not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {num_shards - 1}")
+    return index, num_shards
+
+
+def get_input_format(path, input_format=None):
+    if input_format:
+        return input_format
+    extension = os.path.splitext(path)[1].lower()
+    return {".csv": "CSV", ".xlsx": "XLSX"}.get(extension, "TXT")
+
+
+def open_input(path, input_format):
+    if path != STDIN_PATH:
+        return open(path, "rb")
+    if input_format == "XLSX":  # xlsx files are zip files, which can't be read without seeking
+        return io.BytesIO(sys.stdin.buffer.read())
+    return sys.stdin.buffer
+
+
+def iter_shard(memories, shard):
+    # round-robin, so every shard gets its rows while the input is streamed (and merge can interleave them back)
+    index, num_shards = shard
+    return islice(memories, index, None, num_shards)
+
+
+def get_input_id(path, shard):
+    """
+    Identifies the input (by its content) and the shard, so coding it again resumes it
+    """
+    input_hash = hashlib.sha256(f"{shard[0]}/{shard[1]}".encode("utf-8"))
+    with open(path, "rb") as f:
+        while chunk := f.read(INPUT_HASH_CHUNK_SIZE):
+            input_hash.update(chunk)
+    return input_hash.digest()
+
+
+def code_command(args):
+    input_format = get_input_format(args.input, args.input_format)
+    output_format = args.output_format or get_output_format(args.output)
+    if output_format is None:
+        sys.exit(f"Unknown output format of {args.output}, set it with --output-format")
+    if not RESULTS_WRITERS[output_format].supports(args.coding_task):
+        sys.exit(f"The {output_format} output format isn't for {args.coding_task} results")
+    if args.trace:
+        set_trace_path(args.trace)
+    log_sink = BufferedLogSink(create_generation_log_sink(args.log_sink))
+    client = create_client(args.service, args.api_key, args.base_url) if args.base_url else None
+    coder = Coder({MODEL_SERVICE: args.service, BASE_LLM: args.base_llm, CODING_TASK: args.coding_task},
+                  api_key=args.api_key, client=client, log_sink=log_sink, user=args.user,
+                  warning_callback=lambda message: print(message, file=sys.stderr), failover=not args.no_failover)
+    if args.job_id:
+        job_id = args.job_id
+    elif args.input != STDIN_PATH:
+        job_id = coder.get_batch_job_id(get_input_id(args.input, args.shard))
+    else:  # stdin can't be read twice, so it can't be resumed
+        job_id = uuid.uuid4().hex
+    if args.no_resume:
+        get_batch_job_checkpoint().clear(job_id)
+    results_writer = create_results_writer(output_format, args.coding_task, args.output)
+
+    num_read_memories = [0]
+
+    def report_progress(num_coded, num_memories):
+        num_read_memories[0] = num_memories or 0
+        total = f" of {num_memories}" if num_memories is not None else ""
+        print(f"\rCoded {num_coded}{total} memories", end="", file=sys.stderr, flush=True)
+
+    input_file = open_input(args.input, input_format)
+    try:
+        memories = iter_shard(INPUT_READERS[input_format](input_file), args.shard)
+        memories, results, _, failed_rows = coder.run_batch_job(
+            job_id, memories, max_workers=args.workers, pack_size=args.pack_size, use_cache=not args.no_cache,
+            progress_callback=report_progress, row_callback=results_writer.write, keep_results=False)
+    except BaseException:
+        results_writer.discard()
+        raise
+    finally:
+        if input_file is not sys.stdin.buffer:
+            input_file.close()
+        log_sink.close()
+    results_writer.finish(memories, results, num_read_memories[0])
+    print(f"\nWrote the results of {num_read_memories[0]} memories to {args.output} (job {job_id})", file=sys.stderr)
+    if not failed_rows:  # the job is done, so there is nothing to resume
+        get_batch_job_checkpoint().clear(job_id)
+    else:
+        print(f"Failed to code {len(failed_rows)} memories (their results are left empty, or malformed), "
+              f"running the same command again will only retry them. The first error was: "
+              f"{next(iter(failed_rows.values()))}", file=sys.stderr)
+        sys.exit(1)
+
+
+def open_csv_results(path):
+    if path.lower().endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def merge_command(args):
+    """
+    Interleaves the results of the shards back to the input's order (shard i has rows i, i + N, i + 2N, ...)
+    """
+    output_format = args.output_format or get_output_format(args.output)
+    if output_format is None:
+        sys.exit(f"Unknown output format of {args.output}, set it with --output-format")
+    if not RESULTS_WRITERS[output_format].supports(args.coding_task):
+        sys.exit(f"The {output_format} output format isn't for {args.coding_task} results")
+    shard_files = [open_csv_results(path) for path in args.shards]
+    results_writer = RESULTS_WRITERS[output_format](args.output, args.coding_task)
+    try:
+        readers = [csv.reader(shard_file) for shard_file in shard_files]
+        for reader in readers:
+            next(reader, None)  # the header
+        num_rows = 0
+        while (row := next(readers[num_rows % len(readers)], None)) is not None:
+            results_writer.write_row(*row[:len(EXPORT_COLUMNS)])
+            num_rows += 1
+    finally:
+        results_writer.close()
+        for shard_file in shard_files:
+            shard_file.close()
+    print(f"Merged {num_rows} rows from {len(shard_files)} shards to {args.output}", file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    code_parser = commands.add_parser("code", help="code the memories of a TXT, CSV or XLSX file (or stdin)")
+    code_parser.add_argument("input", help=f"the input file, or {STDIN_PATH} for stdin (one memory per line, "
+                                           f"unless --input-format says otherwise)")
+    code_parser.add_argument("-o", "--output", required=True, help="the results file, written while coding")
+    code_parser.add_argument("--input-format", choices=list(INPUT_READERS), help="by default by the extension")
+    code_parser.add_argument("--output-format", choices=list(RESULTS_WRITERS), help="by default by the extension")
+    code_parser.add_argument("--coding-task", choices=ALL_CODING_TASKS, default=DEFAULT_MODEL_CONFIG[CODING_TASK])
+    code_parser.add_argument("--service", choices=list(MODEL_SERVICES_AVAILABLE_LLMS),
+                             default=DEFAULT_MODEL_CONFIG[MODEL_SERVICE])
+    code_parser.add_argument("--base-llm", default=DEFAULT_MODEL_CONFIG[BASE_LLM])
+    code_parser.add_argument("--base-url", help=f"of another OpenAI-compatible server for the {FREE_SERVICE} service")
+    code_parser.add_argument("--api-key", default=os.environ.get("HF_API_KEY"),
+                             help="by default the HF_API_KEY environment variable")
+    code_parser.add_argument("--user", default=HEADLESS_USER, help="the user name in the generation logs")
+    code_parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS_DEFAULT,
+                             help="number of memories to code in parallel")
+    code_parser.add_argument("--pack-size", type=int, default=PACKED_MEMORIES_DEFAULT,
+                             help="number of memories to code in a single request")
+    code_parser.add_argument("--shard", type=parse_shard, default=(0, 1),
+                             help="i/N to code only the i-th (0-based) of N shards of the input")
+    code_parser.add_argument("--job-id", help="resume this batch job, by default the input file and shard's job")
+    code_parser.add_argument("--no-resume", action="store_true", help="code again memories that were coded "
+                                                                      "by a previous run")
+    code_parser.add_argument("--no-cache", action="store_true", help="don't reuse results of memories that were "
+                                                                     "already coded with this configuration")
+    code_parser.add_argument("--no-failover", action="store_true",
+                             help="don't fail over to (or hedge slow requests with) the service's backup model")
+    code_parser.add_argument("--trace", nargs="?", const=TRACE_FILE_PATH,
+                             help=f"export the timing of every stage to a local trace file ({TRACE_FILE_PATH} by default)")
+    code_parser.add_argument("--log-sink", choices=[JSONL_LOG_SINK, SQLITE_LOG_SINK], default=JSONL_LOG_SINK)
+    code_parser.set_defaults(func=code_command)
+
+    merge_parser = commands.add_parser("merge", help="merge the CSV results of the shards of an input")
+    merge_parser.add_argument("shards", nargs="+", help="the CSV (or CSV gzip) results of the shards, in order")
+    merge_parser.add_argument("-o", "--output", required=True)
+    merge_parser.add_argument("--output-format", choices=list(RESULTS_WRITERS), help="by default by the extension")
+    merge_parser.add_argument("--coding-task", choices=ALL_CODING_TASKS, default=DEFAULT_MODEL_CONFIG[CODING_TASK],
+                              help="for the parsed columns of Parquet results")
+    merge_parser.set_defaults(func=merge_command)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+from process_wide import process_wide
+from constants import *
+
+
+def create_client(service, api_key, base_url=FREE_SERVICE_BASE_URL):
+    # the SDKs are imported only for the service that is used, both are slow to import
+    if service == LOCAL_SERVICE:
+        from local_inference import LocalClient
+        return LocalClient()
+    if service == PRIVATE_SERVICE:
+        from huggingface_hub import InferenceClient
+        configure_hub_http_client()
+        return InferenceClient(provider="hf-inference", api_key=api_key, timeout=CLIENT_TIMEOUT_SECONDS)
+    # service == FREE_SERVICE
+    # return Together(api_key=st.secrets["TOGETHER_API_KEY"])
+    from openai import OpenAI, DefaultHttpxClient, DEFAULT_CONNECTION_LIMITS, DEFAULT_TIMEOUT
+    Limits, Timeout = type(DEFAULT_CONNECTION_LIMITS), type(DEFAULT_TIMEOUT)  # the installed SDK's httpx flavour
+    http_client = DefaultHttpxClient(limits=Limits(max_connections=CLIENT_MAX_CONNECTIONS,
+                                                   max_keepalive_connections=CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+                                                   keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY_SECONDS))
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=http_client,
+                  timeout=Timeout(CLIENT_TIMEOUT_SECONDS, connect=CLIENT_CONNECT_TIMEOUT_SECONDS),
+                  max_retries=0)  # retries are done by the scheduler (see scheduling.py)
+
+
+@process_wide  # once
+def configure_hub_http_client():
+    """
+    The InferenceClient has no connection settings of its own: it sends its requests with huggingface_hub's
+    process-wide httpx client, so the same pool limits and keep-alive as the OpenAI client's are set there
+    """
+    from huggingface_hub import set_client_factory
+    from huggingface_hub.utils._http import httpx2, hf_request_event_hook  # the hub's own httpx and hook
+
+    def create_hub_http_client():
+        return httpx2.Client(event_hooks={"request": [hf_request_event_hook]}, follow_redirects=True,
+                             timeout=None,  # set by the InferenceClient per request
+                             limits=httpx2.Limits(max_connections=CLIENT_MAX_CONNECTIONS,
+                                                  max_keepalive_connections=CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+                                                  keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY_SECONDS))
+    set_client_factory(create_hub_http_client)
+
+
+@process_wide
+def get_client(service, api_key):
+    """
+    The client of the service, shared by all the sessions (and their batch workers),
+    so they share its connection pool instead of each opening new connections
+    """
+    return create_client(service, api_key)
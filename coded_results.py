@@ -0,0 +1,74 @@
+import re
+from collections import namedtuple
+from constants import *
+
+SLV_CODE_REGEX = (r"_(?P<locus>" + "|".join(SLV_CLASS_COLORS) + r")_(?P<valence>"
+                  + "|".join(SLV_VALENCE_COLORS) + r")_")
+SLV_CODE_PATTERN = re.compile(r"\s*" + SLV_CODE_REGEX + r"\s*")
+SLV_SEGMENT_PATTERN = re.compile(r"(?P<text>.*?)\s*" + SLV_CODE_REGEX, re.DOTALL)
+COH_SCORES_REGEX = (r"Context:\s*(?P<context>[0-3])\s*\n\s*Chronology:\s*(?P<chronology>[0-3])\s*\n"
+                    r"\s*Theme:\s*(?P<theme>[0-3])")
+COH_SCORES_PATTERN = re.compile(COH_SCORES_REGEX)  # the scores anywhere in a model's output
+COH_RESULT_PATTERN = re.compile(r"^\s*" + COH_SCORES_REGEX + r"\s*\nTotal: (?P<total>\d{1,2})\s*$")  # fits int8
+MALFORMED_COH_SCORES = (-1, -1, -1, -1)
+COH_DIMENSIONS = ["context", "chronology", "theme"]
+
+# span is the segment's [start, end) in the coded result
+SlvSegment = namedtuple("SlvSegment", ["text", "locus", "valence", "start", "end"])
+CohScores = namedtuple("CohScores", ["context", "chronology", "theme", "total", "is_total_consistent"])
+
+
+class MalformedResultError(ValueError):
+    pass
+
+
+def parse_slv_result(result: str):
+    segments = []
+    for match in SLV_SEGMENT_PATTERN.finditer(result):
+        text = match.group("text")
+        stripped_text = text.lstrip(" \t\n.,;:!?")  # punctuation left after the previous code
+        start = match.start("text") + len(text) - len(stripped_text)
+        stripped_text = stripped_text.rstrip()
+        segments.append(SlvSegment(stripped_text, match.group("locus"), match.group("valence"),
+                                   start, start + len(stripped_text)))
+    return segments
+
+
+def parse_coh_result(result: str):
+    match = COH_RESULT_PATTERN.match(result)
+    if match is None:
+        return None
+    scores = [int(match.group(dimension)) for dimension in COH_DIMENSIONS]
+    total = int(match.group("total"))
+    return CohScores(*scores, total, total == sum(scores))
+
+
+def is_valid_coded_result(memory, result, coding_task):
+    if not result:
+        return False
+    if coding_task == SEGMENT_LOCUS_VALENCE:  # the output must be the input with codes added
+        return (SLV_CODE_PATTERN.search(result) is not None
+                and " ".join(SLV_CODE_PATTERN.sub(" ", result).split()) == " ".join(memory.split()))
+    if coding_task == NARRATIVE_COHERENCE:
+        scores = parse_coh_result(result)
+        return scores is not None and scores.is_total_consistent
+    return True
+
+
+def get_coh_scores(result):
+    """
+    :return: the context, chronology, theme and total (computed locally) scores of a NaCCS result,
+             or MALFORMED_COH_SCORES
+    """
+    scores = parse_coh_result(result or "")
+    if scores is None:
+        return MALFORMED_COH_SCORES
+    return scores.context, scores.chronology, scores.theme, scores.context + scores.chronology + scores.theme
+
+
+def get_coh_scores_array(results):
+    """
+    :return: (num_results, 4) int8 array of the results' scores (see get_coh_scores)
+    """
+    import numpy as np
+    return np.array([get_coh_scores(result) for result in results], dtype=np.int8).reshape(-1, 4)
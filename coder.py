@@ -0,0 +1,160 @@
+from clients import get_client
+from prompting import get_system_prompt, generate_with_retries, save_generation_log, raw_generation, \
+    load_example_indices
+from memory_coding import code_memory
+from coded_results import get_coh_scores_array
+from batch_coding import code_memories
+from batch_jobs import get_batch_job_id, run_batch_job
+from chat_context import ChatContext
+from routing import Route
+from constants import *
+
+
+class Coder:
+    """
+    Codes memories with an explicit model configuration, client, log sink and user,
+    instead of the streamlit session's, so it also runs headless (e.g. in worker processes and cron jobs).
+    The streamlit pages only adapt it to the session (see get_session_coder in main.py).
+    """
+    def __init__(self, model_config: dict[str, str] = None, api_key=None, client=None, log_sink=None,
+                 user=HEADLESS_USER, warning_callback=None, failover=True, examples_loader=None):
+        """
+        :param model_config: the MODEL_SERVICE, BASE_LLM and CODING_TASK (DEFAULT_MODEL_CONFIG's for missing ones)
+        :param client: the model service's client, by default the process-wide one of api_key (see clients.py)
+        :param log_sink: where the generation logs are saved, the process-wide sink by default
+        :param warning_callback: called with a message when a generation is re-tried, or fails
+        :param failover: whether to fail over to the service's backup model (see BACKUP_MODEL_CONFIGS and routing.py),
+                         and hedge its slow requests with it, when there is an api_key for it
+        :param examples_loader: examples_loader(sheet) returns the private examples of the sheet
+                                (e.g. prompting.get_private_examples in the app), which are loaded here,
+                                in the calling thread, once per process. Without it, only the examples
+                                that are already loaded are added to the prompts (none in a headless process).
+        """
+        model_config = {**DEFAULT_MODEL_CONFIG, **(model_config or {})}
+        self.service, self.base_llm = model_config[MODEL_SERVICE], model_config[BASE_LLM]
+        self.coding_task = model_config[CODING_TASK]
+        self.client = client or get_client(self.service, api_key)
+        self.log_sink = log_sink
+        self.user = user
+        self.warning_callback = warning_callback
+        self.backup_routes = self.get_backup_routes(api_key) if failover else []
+        if examples_loader is not None:
+            load_example_indices(self.coding_task, examples_loader)
+
+    def get_backup_routes(self, api_key):
+        backup_config = BACKUP_MODEL_CONFIGS.get(self.service)
+        if api_key is None or backup_config is None or backup_config[BASE_LLM] == self.base_llm:
+            return []
+        backup_service = backup_config[MODEL_SERVICE]
+        return [Route(get_client(backup_service, api_key), backup_service, backup_config[BASE_LLM])]
+
+    @property
+    def model_parameters(self):
+        return self.client, self.service, self.base_llm, self.coding_task
+
+    def get_system_prompt(self, prompt_type_task=DIRECT_CODING_TASK):
+        return get_system_prompt(prompt_type_task, self.coding_task)
+
+    def get_message_history(self, prompt_type_task=DIRECT_CODING_TASK):
+        return [{"role": "system", "content": self.get_system_prompt(prompt_type_task)}]
+
+    def save_logs(self, logs: list[dict[str, str]]):
+        save_generation_log(multiple_generation_logs=[log for log in logs if log], log_sink=self.log_sink)
+
+    def code(self, memory: str, use_cache=True, generation_func=None, **kwargs):
+        """
+        :param generation_func: e.g. a streaming one (see prompting.get_streaming_generation_func),
+                                long memories are coded in windows (see segmented_coding.py) and aren't streamed
+        :return: the coded result and its generation log (which is already saved)
+        """
+        result, _, log = code_memory(memory, self.get_message_history(), use_cache, generation_func,
+                                   model_parameters=self.model_parameters, user=self.user,
+                                   warning_callback=self.warning_callback, backup_routes=self.backup_routes, **kwargs)
+        self.save_logs([log])
+        return result, log
+
+    def code_memories(self, memories, max_workers=BATCH_MAX_WORKERS_DEFAULT, progress_callback=None, **kwargs):
+        """
+        Codes many memories concurrently (see batch_coding.code_memories)
+        :return: memories, results and generation logs (which are already saved), in the input order
+        """
+        memories, results, logs = code_memories(memories, self.get_message_history(), self.model_parameters,
+                                                self.user, max_workers, progress_callback,
+                                                warning_callback=self.warning_callback, log_sink=self.log_sink,
+                                                backup_routes=self.backup_routes, **kwargs)
+        self.save_logs(logs)
+        return memories, results, logs
+
+    def score_memories(self, memories, max_workers=BATCH_MAX_WORKERS_DEFAULT, progress_callback=None, **kwargs):
+        """
+        Codes many memories with the NaCCS coding task (see coherence_scoring.py)
+        :return: memories, a (num_memories, 4) int8 array of their context, chronology, theme and total scores
+                 (-1 for malformed results) and the generation logs, in the input order
+        """
+        if self.model_parameters[3] != NARRATIVE_COHERENCE:
+            raise ValueError(f"Only {NARRATIVE_COHERENCE} results have scores, not {self.model_parameters[3]}")
+        memories, results, logs = self.code_memories(memories, max_workers, progress_callback, **kwargs)
+        return memories, get_coh_scores_array(results), logs
+
+    def get_batch_job_id(self, input_content: bytes):
+        return get_batch_job_id(input_content, self.model_parameters, self.get_system_prompt())
+
+    def run_batch_job(self, job_id, memories, **kwargs):
+        """
+        Codes the memories of a resumable batch job (see batch_jobs.run_batch_job and get_batch_job_id)
+        :return: memories, results, generation logs and a {row_index: error} dict of the failed rows
+        """
+        return run_batch_job(job_id, memories, self.get_message_history(), self.model_parameters, self.user,
+                             log_sink=self.log_sink, warning_callback=self.warning_callback,
+                             backup_routes=self.backup_routes, **kwargs)
+
+    def new_chat(self):
+        return ChatContext(self.get_system_prompt(CHAT_TASK))
+
+    def chat_turn(self, context: ChatContext, user_message, generation_func=raw_generation, **kwargs):
+        """
+        Answers the user's message in the conversation (see chat_context.ChatContext),
+        summarizing its older turns first if they outgrew the token budget
+        :return: the model's answer and its generation log (which is already saved)
+        """
+        context.add_message("user", user_message)
+        if context.needs_summary():
+            self.summarize_chat(context)
+        output, log = generate_with_retries(context.get_request_messages(), generation_func, CHAT_TASK,
+                                            self.model_parameters, self.user, warning_callback=self.warning_callback,
+                                            backup_routes=self.backup_routes, **kwargs)
+        log[INPUT_COLUMN] = str(context.get_unlogged_messages())  # the full history is logged by the earlier turns
+        log[CONVERSATION_ID_COLUMN] = context.conversation_id
+        context.add_answer(output)
+        self.save_logs([log])
+        return output, log
+
+    def summarize_chat(self, context: ChatContext):
+        summary_start, summary_end = context.num_summarized, context.get_summary_end()
+        if summary_end <= summary_start:
+            return
+        try:
+            summary, log = generate_with_retries(context.get_summary_messages(summary_end), raw_generation,
+                                                 CHAT_SUMMARY_TASK, self.model_parameters, self.user,
+                                                 warning_callback=self.warning_callback,
+                                                 backup_routes=self.backup_routes)
+        except Exception as e:  # the oldest turns are only dropped then, to fit in the budget
+            if self.warning_callback is not None:
+                self.warning_callback(f"Failed to summarize the older messages of the conversation: {e}")
+            return
+        if summary:
+            context.set_summary(summary, summary_end)
+        log[INPUT_COLUMN] = context.get_summary_log_input(summary_start, summary_end)
+        log[CONVERSATION_ID_COLUMN] = context.conversation_id
+        self.save_logs([log])
+
+    def chat(self, messages: list[dict[str, str]], generation_func=raw_generation, **kwargs):
+        """
+        :param messages: the conversation so far, starting with the system prompt of CHAT_TASK
+        :return: the model's answer and its generation log (which is already saved)
+        """
+        output, log = generate_with_retries(messages, generation_func, CHAT_TASK, self.model_parameters, self.user,
+                                            warning_callback=self.warning_callback,
+                                            backup_routes=self.backup_routes, **kwargs)
+        self.save_logs([log])
+        return output, log
@@ -0,0 +1,47 @@
+"""
+A score-only engine for NaCCS (NARRATIVE_COHERENCE) coding, whose useful output is only the dimensions' scores:
+generation stops right before the model's Total (computed locally instead), and max_tokens is capped to what the
+scores take, instead of the free-text budget of SLV coding.
+The result is still the task's usual text format, so it is cached, validated, highlighted and exported as before.
+"""
+from prompting import code_text
+from coded_results import is_valid_coded_result, COH_SCORES_PATTERN, COH_DIMENSIONS
+from constants import *
+
+
+def get_score_generation_kwargs(base_llm, **kwargs):
+    """
+    :return: the generation kwargs, with the stop sequences and the capped max_tokens unless they are given
+    """
+    return {STOP_PARAM: COH_STOP_SEQUENCES,
+            MAX_TOKENS_PARAM: COH_SCORE_MAX_TOKENS + REASONING_LLMS_MAX_TOKENS.get(base_llm, 0), **kwargs}
+
+
+def format_coh_scores(context, chronology, theme):
+    return f"Context: {context}\nChronology: {chronology}\nTheme: {theme}\nTotal: {context + chronology + theme}"
+
+
+def complete_coh_result(output):
+    """
+    :return: the result in the task's format with the Total computed locally,
+             or the output as is if it has no scores (so it is found malformed)
+    """
+    match = COH_SCORES_PATTERN.search(output or "")
+    if match is None:
+        return output
+    return format_coh_scores(*(int(match.group(dimension)) for dimension in COH_DIMENSIONS))
+
+
+def score_memory(memory, message_history=None, use_cache=True, generation_func=None, *, model_parameters,
+                 **kwargs):
+    """
+    code_text with the score-only generation parameters (see get_score_generation_kwargs)
+    :return: the result (with the local Total), the messages and the generation log (of the model's output)
+    """
+    kwargs = get_score_generation_kwargs(model_parameters[2], **kwargs)
+    output, messages, log = code_text(memory, message_history, use_cache, generation_func,
+                                      model_parameters=model_parameters,
+                                      output_validator=lambda output: is_valid_coded_result(
+                                          memory, complete_coh_result(output), model_parameters[3]),
+                                      **kwargs)
+    return complete_coh_result(output), messages, log
@@ -1,5 +1,3 @@
-import streamlit as st
-from streamlit_gsheets import GSheetsConnection
 
 # page names
 WELCOME_PAGE = "welcome"
@@ -50,6 +48,7 @@ ALL_CODING_TASK_PARAMETERS = [TASK_DEFINITION, INPUT_FORMAT_INSTRUCTION, OUTPUT_
                               PUBLIC_CORRECT_EXAMPLES, PUBLIC_INCORRECT_EXAMPLES,
                               PRIVATE_CORRECT_EXAMPLES_SHEET, PRIVATE_INCORRECT_EXAMPLES_SHEET,
                               FORMATTED_CODES_DICT, COLOR_CODING_LEGEND]
+HIGHLIGHT_CACHE_SIZE = 1024  # number of highlighted texts to keep per coding task
 
 # Segment-Locus-Valence (`slv`) coding
 SLV_CLASS_COLORS = {"int": "blue", "ext": "gray"}
@@ -139,7 +138,8 @@ for task in ALL_CODING_TASKS:
 # model config
 FREE_SERVICE = "Cerebras"  # "TogetherAI"
 PRIVATE_SERVICE = "HuggingFaceHub"
-MODEL_SERVICES_DESCRIPTION = {FREE_SERVICE: "free", PRIVATE_SERVICE: "private"}
+LOCAL_SERVICE = "Local"  # runs on this machine's CPU (see local_inference.py)
+MODEL_SERVICES_DESCRIPTION = {FREE_SERVICE: "free", PRIVATE_SERVICE: "private", LOCAL_SERVICE: "local (offline)"}
 MODEL_SERVICES_AVAILABLE_LLMS = {
     FREE_SERVICE: [
         # "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"  # deprecated by TogetherAI
@@ -150,14 +150,63 @@ MODEL_SERVICES_AVAILABLE_LLMS = {
         "meta-llama/Llama-3.3-70B-Instruct",
         # "deepseek-ai/DeepSeek-R1-Distill-Qwen-32B",  # uses <think>
         "microsoft/phi-4"
+    ],
+    LOCAL_SERVICE: [
+        "Qwen/Qwen2.5-1.5B-Instruct",
+        "Qwen/Qwen2.5-0.5B-Instruct"
     ]
 }
+FREE_SERVICE_BASE_URL = "https://router.huggingface.co/v1"
 MODEL_SERVICE, BASE_LLM, CODING_TASK = "model_service", "base_llm", "coding_task"
 MODEL_CONFIG_KEYS = [MODEL_SERVICE, BASE_LLM, CODING_TASK]
 DEFAULT_MODEL_CONFIG = {MODEL_SERVICE: FREE_SERVICE,
                         BASE_LLM: MODEL_SERVICES_AVAILABLE_LLMS[FREE_SERVICE][0],
                         CODING_TASK: DEFAULT_CODING_TASK}
 
+# model service clients (shared by all sessions)
+CLIENT_MAX_CONNECTIONS = 100
+CLIENT_MAX_KEEPALIVE_CONNECTIONS = 20
+CLIENT_KEEPALIVE_EXPIRY_SECONDS = 120
+CLIENT_TIMEOUT_SECONDS = 600  # thinking models can take a while
+CLIENT_CONNECT_TIMEOUT_SECONDS = 10
+
+# local models (loaded once per process, on their first use)
+LOCAL_NUM_THREADS = None  # of the CPU, all of them by default
+LOCAL_MAX_BATCH_SIZE = 8  # memories generated in a single padded batch, like BATCH_MAX_WORKERS_DEFAULT
+LOCAL_BATCH_WAIT_SECONDS = 0.05  # for more requests to batch with the first one
+LOCAL_PREFIX_CACHE_SIZE = 4  # system prompts whose keys and values are kept
+
+# rate limits of the model services (shared by all sessions)
+REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE = "requests_per_minute", "tokens_per_minute"
+SERVICE_RATE_LIMITS = {
+    FREE_SERVICE: {REQUESTS_PER_MINUTE: 30, TOKENS_PER_MINUTE: 64000},
+    PRIVATE_SERVICE: {REQUESTS_PER_MINUTE: 60, TOKENS_PER_MINUTE: 200000},
+    LOCAL_SERVICE: {REQUESTS_PER_MINUTE: 10 ** 6, TOKENS_PER_MINUTE: 10 ** 9},  # only limited by the CPU
+}
+DEFAULT_RATE_LIMITS = {REQUESTS_PER_MINUTE: 60, TOKENS_PER_MINUTE: 200000}
+RETRIABLE_STATUS_CODES = [408, 409, 429, 500, 502, 503, 504]
+INPUT_ERROR_STATUS_CODES = [400, 413, 422]  # e.g. a prompt longer than the context, which any route would reject
+SCHEDULER_MAX_RETRIES = 6
+SCHEDULER_BACKOFF_BASE_SECONDS = 1
+SCHEDULER_BACKOFF_MAX_SECONDS = 60
+
+# routing between the model services (failover and hedged requests, shared by all sessions)
+BACKUP_MODEL_CONFIGS = {  # the backup of every service, used only with an API key for it (none for local models,
+                          # whose memories might be too sensitive to leave the machine)
+    FREE_SERVICE: {MODEL_SERVICE: PRIVATE_SERVICE, BASE_LLM: MODEL_SERVICES_AVAILABLE_LLMS[PRIVATE_SERVICE][0]},
+    PRIVATE_SERVICE: {MODEL_SERVICE: FREE_SERVICE, BASE_LLM: MODEL_SERVICES_AVAILABLE_LLMS[FREE_SERVICE][0]},
+}
+PRIMARY_ROUTE, HEDGE_ROUTE, FAILOVER_ROUTE = "primary", "hedge", "failover"  # why a route served a generation
+ROUTE_LATENCY_WINDOW = 200  # recent latencies of every route and task to compute the hedging deadline from
+ROUTE_MIN_LATENCY_SAMPLES = 20  # no hedging before that many latencies are known
+ROUTE_HEDGE_PERCENTILE = 0.95  # a request slower than this percentile of its route's latencies is hedged
+ROUTE_MIN_HEDGE_DEADLINE_SECONDS = 1
+ROUTE_HEALTH_WINDOW = 20  # recent requests of every route to compute its error rate from
+ROUTE_MIN_HEALTH_SAMPLES = 5
+ROUTE_UNHEALTHY_ERROR_RATE = 0.5  # a route failing this often is skipped...
+ROUTE_UNHEALTHY_COOLDOWN_SECONDS = 30  # ...until it didn't fail for this long
+ROUTER_MAX_THREADS = 64  # requests that can wait for their hedging deadline at once
+
 # generation log
 TIMESTAMP_COLUMN = "timestamp"
 USERNAME_COLUMN = "user"
@@ -168,12 +217,38 @@ INPUT_COLUMN = "input"
 GEN_KWARGS_COLUMN = "generation_kwargs"
 OUTPUT_COLUMN = "output"
 TASK_COLUMN = "task"  # direct/chat, in contrast to the type of coding (like valence/coherence/etc.)
+SPANS_COLUMN = "spans"  # the timing of the generation's stages (see instrumentation.py)
+USAGE_COLUMN = "usage"  # tokens reported by the model service, summed over all the attempts
+CONVERSATION_ID_COLUMN = "conversation_id"  # of chat turns, whose input is only the messages new to the log
+ROUTE_COLUMN = "route"  # the service and model that generated the output, and why (see routing.py)
 GENERATION_LOG_COLUMNS = [TIMESTAMP_COLUMN, USERNAME_COLUMN, SERVICE_COLUMN, BASE_LLM_COLUMN,
                           CODING_TASK_COLUMN, INPUT_COLUMN, GEN_KWARGS_COLUMN, OUTPUT_COLUMN,
-                          TASK_COLUMN]
+                          TASK_COLUMN, SPANS_COLUMN, USAGE_COLUMN, CONVERSATION_ID_COLUMN, ROUTE_COLUMN]
+HEADLESS_USER = "headless"  # logged as the user of generations that were not made from the app
+PROMPT_TOKENS = "prompt_tokens"
+COMPLETION_TOKENS = "completion_tokens"
+
+# generation log sinks (all of them only append new rows)
+GSHEETS_LOG_SINK = "gsheets"
+JSONL_LOG_SINK = "jsonl"
+SQLITE_LOG_SINK = "sqlite"
+GENERATION_LOG_SINK_TYPE = GSHEETS_LOG_SINK  # of the app, headless runs have no sheet connection
+HEADLESS_GENERATION_LOG_SINK_TYPE = JSONL_LOG_SINK
+LOCAL_GENERATION_LOG_JSONL_PATH = "generation_log.jsonl"
+LOCAL_GENERATION_LOG_SQLITE_PATH = "generation_log.sqlite"
+GENERATION_LOG_FLUSH_INTERVAL_SECONDS = 2
+GENERATION_LOG_MAX_BATCH_SIZE = 500
+GENERATION_LOG_CLOSE_TIMEOUT_SECONDS = 30
+GENERATION_LOG_MAX_RETRIES = 3  # then the batch is written to the fallback file instead
+GENERATION_LOG_FALLBACK_JSONL_PATH = "generation_log_unsaved.jsonl"  # logs that the sink failed to write
+GSHEETS_MAX_CELL_CHARS = 50000  # longer cells are rejected by Google Sheets
+GSHEETS_TRUNCATED_CELL_SUFFIX = "... [truncated]"
 
 DIRECT_CODING_TASK = "direct_coding"
+PACKED_CODING_TASK = "packed_coding"  # several memories coded in a single request
+SEGMENTED_CODING_TASK = "segmented_coding"  # a long memory coded in windows (see segmented_coding.py)
 CHAT_TASK = "chat"
+CHAT_SUMMARY_TASK = "chat_summary"  # summarizing the older turns of a chat
 
 # prompts
 SYSTEM_INTRO = "You are a useful assistant for a clinical psychology research, used to code memory segments of patients by a coding scheme, so they can be used for research."
@@ -199,6 +274,15 @@ YOUR ACTUAL ROLE:
 - Do NOT automatically format your responses according to the input/output specifications above
 Always maintain a helpful, conversational tone while assisting with this coding task."""
 
+CONTINUE_TRUNCATED_OUTPUT_INSTRUCTION = "Your last output was cut off. Continue it exactly from where it stopped, without repeating anything and without adding any other text."
+
+PACKED_INPUT_INSTRUCTION = """IMPORTANT! This time you will get several memories in a single message, each one between a "### MEMORY <number>" line and a "### END <number>" line.
+Code each memory separately and independently, exactly as instructed above, and output the coded result of each memory between a "### RESULT <number>" line and a "### END <number>" line (with the memory's number), in the same order, without any other text."""
+
+CHAT_SUMMARY_TITLE = "SUMMARY OF THE EARLIER CONVERSATION (its latest messages follow):"
+CHAT_SUMMARY_INSTRUCTION = "You summarize conversations between researchers and an assistant about coding memories by a coding scheme. Write a concise summary of the given conversation (and of the summary of the earlier conversation, if given), keeping every memory that was discussed, every coding decision and its reasoning, and every question that is still open. Output only the summary."
+SEGMENTED_CONTEXT_INSTRUCTION = "The input is only a part of a longer memory, whose other parts are coded separately. Code only the given part, exactly as instructed above, but in the context of the whole memory (e.g. keep the locus of its main event consistent). The memory begins with:\n{beginning}\n\nThe text right before the given part is:\n{previous}"
+FEW_SHOT_TITLE = "MORE EXAMPLES, SIMILAR TO THE INPUT:"
 STRICT_OUTPUT_FORMAT_REMINDER = "IMPORTANT! Remember to ONLY output the coded text according to this format, and to NOT add any other notes or explanations!"
 
 # generation parameters
@@ -206,22 +290,124 @@ TEMPERATURE_PARAM = "temperature"
 DEFAULT_TEMPERATURE = 0
 MAX_TOKENS_PARAM = "max_tokens"
 MAX_TOKENS_DEFAULT = 4096  # the default in ServiceNow-AI/Apriel-1.6-15b-Thinker is 2048
-MAX_TOKENS_INC_STEP = 1000
 DEFAULT_GENERATION_PARAMETERS = {
     TEMPERATURE_PARAM: DEFAULT_TEMPERATURE,
     MAX_TOKENS_PARAM: MAX_TOKENS_DEFAULT,
 }
 
+STOP_PARAM = "stop"
 MAX_ALLOWED_RETRIES = 5
 
+# score-only NaCCS coding (see coherence_scoring.py)
+COH_STOP_SEQUENCES = ["\nTotal"]  # the total is computed locally
+COH_SCORE_MAX_TOKENS = 64  # the three scores take ~20 tokens
+REASONING_LLMS_MAX_TOKENS = {  # the tokens these LLMs think for before answering
+    "openai/gpt-oss-120b:cerebras": 2048
+}
+
+# adaptive max tokens (learned per base-LLM and coding task)
+TOKEN_BUDGET_WINDOW = 500  # number of recent generations to learn from
+TOKEN_BUDGET_MIN_OBSERVATIONS = 20  # until then MAX_TOKENS_DEFAULT is used
+TOKEN_BUDGET_PERCENTILE = 99
+TOKEN_BUDGET_MARGIN = 0.25
+TOKEN_BUDGET_GROWTH_FACTOR = 2  # on truncation
+TOKEN_BUDGET_MIN_MAX_TOKENS = 256
+TOKEN_BUDGET_MAX_MAX_TOKENS = 32768
+ESTIMATED_CHARS_PER_TOKEN = 4
+FINISH_REASON_LENGTH = "length"
+# services whose truncated output is continued in a follow-up request instead of being thrown away
+CONTINUE_TRUNCATED_OUTPUT_SERVICES = [FREE_SERVICE, PRIVATE_SERVICE, LOCAL_SERVICE]
+
+# long memories (coded in windows of whole sentences, in parallel)
+SEGMENTED_MIN_CHARS = 4000  # longer SLV memories are coded in windows
+SEGMENTED_WINDOW_CHARS = 1500
+SEGMENTED_MAIN_EVENT_CHARS = 400  # the beginning of the memory, given as context to every window
+SEGMENTED_OVERLAP_SENTENCES = 2  # the sentences before a window, given as its context
+SEGMENTED_MAX_WORKERS = 8  # windows coded concurrently, of all the long memories together
+SEGMENTED_WINDOW_RETRIES = 2  # of malformed windows
+
+# private examples (only the most similar ones to every memory are added to its prompt, see example_index.py)
+FEW_SHOT_CORRECT_K = 3
+FEW_SHOT_INCORRECT_K = 2
+FEW_SHOT_MAX_TOKENS = 1500  # of all the selected examples of a memory
+EXAMPLE_INDEX_CANDIDATES_FACTOR = 4  # the most similar examples that are considered for the k that fit the budget
+EXAMPLE_INDEX_BM25_K1 = 1.5
+EXAMPLE_INDEX_BM25_B = 0.75
+
+# response cache (only used for deterministic generation, i.e. temperature 0)
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_PATH = "response_cache.sqlite"
+RESPONSE_CACHE_MAX_SIZE_BYTES = 200 * 1024 ** 2
+RESPONSE_CACHE_EVICTION_BATCH = 100
+
+# chat context window
+CHAT_HISTORY_MAX_TOKENS = 6000  # of the turns sent with every message, besides the system prompt and summary
+CHAT_HISTORY_KEEP_FRACTION = 0.5  # of the budget, the latest turns that are kept as is when older ones are summarized
+CHAT_MESSAGE_OVERHEAD_TOKENS = 4  # the role and separators of every message
+
+# instrumentation
+SPAN_NAME = "name"
+SPAN_DURATION_MS = "duration_ms"
+SPAN_ERROR = "error"
+TIME_TO_FIRST_TOKEN_MS = "time_to_first_token_ms"
+SYSTEM_PROMPT_SPAN = "get_system_prompt"
+SCHEDULER_WAIT_SPAN = "scheduler_wait"  # for the rate limits
+GENERATION_ATTEMPT_SPAN = "generation_attempt"  # a single request to the model service
+BACKOFF_SPAN = "backoff"  # before retrying a failed request
+SAVE_GENERATION_LOG_SPAN = "save_generation_log"  # only queues the logs
+LOG_SINK_WRITE_SPAN = "log_sink_write"  # the actual write, from the background thread
+ROUTING_SPAN = "routing"  # all the requests of a generation attempt, to every route (see routing.py)
+HIGHLIGHT_SPAN = "highlight"
+FEW_SHOT_SPAN = "select_examples"  # of the private examples, for a memory
+SPAN_STATS_WINDOW = 1000  # recent spans of every stage to compute the statistics from
+TRACE_FILE_PATH = "trace.jsonl"  # where spans are exported to, once enabled (on the debug page or in cli.py)
+
+# streaming
+STREAM_RENDER_INTERVAL_SECONDS = 0.1
+LIVE_RESULTS_MAX_ROWS = 50  # latest coded memories shown while a batch is being coded
+
+# batch coding
+BATCH_MAX_WORKERS_DEFAULT = 8  # number of requests sent to the model service concurrently
+BATCH_MAX_WORKERS_LIMIT = 32
+BATCH_IN_FLIGHT_FACTOR = 2  # requests read ahead of the coding, per worker
+PACKED_MEMORIES_DEFAULT = 1  # memories coded in a single request (1 means no packing)
+PACKED_MEMORIES_LIMIT = 20
+
+# resumable batch jobs
+BATCH_JOBS_CHECKPOINT_PATH = "batch_jobs.sqlite"
+BATCH_JOB_ID_LENGTH = 16
+BATCH_JOB_CHECKPOINT_PAGE_SIZE = 10000  # coded rows read at a time when resuming a job
+BATCH_JOB_MAX_ROW_RETRIES = 3  # of a single memory that failed, after the first try
+BATCH_JOB_RETRY_DELAY_SECONDS = 2  # multiplied by the number of the retry
+REGENERATION_TEMPERATURE = 0.3  # for re-coding memories whose result was malformed
+
+# export of batch results
+EXPORT_COLUMNS = ["Input", "Parsed Result"]
+EXPORT_PARQUET_ROW_GROUP_SIZE = 1000
+EXPORT_MAX_PENDING_ROWS = 10000  # coded rows held in memory until the rows before them are written
+
+# ingestion of uploaded files
+INGESTION_CSV_CHUNK_SIZE = 1000
+
+
+def is_running_in_streamlit():
+    import sys
+    if "streamlit" not in sys.modules:  # not imported headless, so don't import it just to check
+        return False
+    from streamlit import runtime
+    return runtime.exists()
+
 
 def validate_model_config():
+    import streamlit as st  # imported by the app anyway, but not needed headless (e.g. by cli.py)
     if "model_config" not in st.session_state:
         st.session_state.model_config = {key: value for key, value in DEFAULT_MODEL_CONFIG.items()}
     return st.session_state.model_config
 
 
 def get_gsheets_connection():
+    import streamlit as st
+    from streamlit_gsheets import GSheetsConnection  # only when the generation logs are saved to the sheet
     if "gsheets_connection" not in st.session_state:
         st.session_state.gsheets_connection = st.connection("gsheets", type=GSheetsConnection)
     return st.session_state.gsheets_connection
@@ -0,0 +1,88 @@
+import re
+import math
+import threading
+from collections import Counter, defaultdict
+from constants import *
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def get_example_key(example):
+    return tuple(example.get(part, "") for part in (INPUT, OUTPUT, EXPLANATION))
+
+
+class ExampleIndex:
+    """
+    A BM25 (TF-IDF like) index of examples by their INPUT, to pick the ones most similar to a memory
+    instead of putting all of them in every prompt.
+    It is updated incrementally (see sync), and only keeps an inverted index, so searching it takes time
+    proportional to the examples that share words with the memory, not to all of them.
+    """
+    def __init__(self, k1=EXAMPLE_INDEX_BM25_K1, b=EXAMPLE_INDEX_BM25_B):
+        self.k1, self.b = k1, b
+        self.examples, self.lengths = [], []
+        self.keys = set()
+        self.postings = defaultdict(lambda: ([], []))  # {term: (example indices, term frequencies)}
+        self.lock = threading.Lock()
+
+    def _add(self, example):
+        terms = Counter(tokenize(example[INPUT]))
+        index = len(self.examples)
+        self.examples.append(example)
+        self.lengths.append(sum(terms.values()))
+        self.keys.add(get_example_key(example))
+        for term, frequency in terms.items():
+            indices, frequencies = self.postings[term]
+            indices.append(index)
+            frequencies.append(frequency)
+
+    def sync(self, examples):
+        """
+        Adds the new examples (without an INPUT they can't be searched, so they are skipped),
+        and rebuilds the index only if some of its examples were removed
+        :return: the number of examples that were indexed
+        """
+        examples = [example for example in examples if example.get(INPUT)]
+        keys = {get_example_key(example) for example in examples}
+        with self.lock:
+            if not self.keys <= keys:
+                self.examples, self.lengths, self.keys = [], [], set()
+                self.postings.clear()
+            num_indexed = 0
+            for example in examples:
+                if get_example_key(example) not in self.keys:  # also skips duplicates in the sheet
+                    self._add(example)
+                    num_indexed += 1
+            return num_indexed
+
+    def search(self, text, limit):
+        """
+        :return: up to `limit` examples that share words with the text, the most similar first
+        """
+        import numpy as np
+        query_terms = set(tokenize(text))
+        with self.lock:
+            num_examples = len(self.examples)
+            if not num_examples:
+                return []
+            lengths = np.asarray(self.lengths, dtype=np.float32)
+            length_norms = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1))
+            scores = np.zeros(num_examples, dtype=np.float32)
+            for term in query_terms:
+                if term not in self.postings:
+                    continue
+                indices, frequencies = (np.asarray(values) for values in self.postings[term])
+                idf = math.log(1 + (num_examples - len(indices) + 0.5) / (len(indices) + 0.5))
+                scores[indices] += idf * frequencies * (self.k1 + 1) / (frequencies + length_norms[indices])
+            limit = min(limit, num_examples)
+            top_indices = np.argpartition(-scores, limit - 1)[:limit]
+            top_indices = top_indices[np.argsort(-scores[top_indices], kind="stable")]
+            return [self.examples[i] for i in top_indices if scores[i] > 0]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.examples)
@@ -0,0 +1,266 @@
+import os
+import csv
+import gzip
+import shutil
+import sqlite3
+import tempfile
+
+from coded_results import parse_slv_result, parse_coh_result, get_coh_scores
+from constants import *
+
+
+class ResultsWriter:
+    """
+    Writes coded results to a file row by row, as they are produced,
+    so the whole batch never has to be held (and copied) in memory to be exported
+    """
+    extension = ""
+    mime = ""
+    coding_tasks = None  # the coding tasks whose results it can write, None for all of them
+
+    def __init__(self, path, coding_task):
+        self.path = path
+        self.coding_task = coding_task
+
+    @classmethod
+    def supports(cls, coding_task):
+        return cls.coding_tasks is None or coding_task in cls.coding_tasks
+
+    def write_row(self, memory, result):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TxtResultsWriter(ResultsWriter):
+    extension, mime = "txt", "text/plain"
+
+    def __init__(self, path, coding_task):
+        super().__init__(path, coding_task)
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write_row(self, memory, result):
+        self.file.write(f"{result}\n")
+
+    def close(self):
+        self.file.close()
+
+
+class CsvResultsWriter(ResultsWriter):
+    extension, mime = "csv", "text/csv"
+
+    def __init__(self, path, coding_task):
+        super().__init__(path, coding_task)
+        self.file = self.open_file(path)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EXPORT_COLUMNS)
+
+    @staticmethod
+    def open_file(path):
+        return open(path, "w", encoding="utf-8", newline="")
+
+    def write_row(self, memory, result):
+        self.writer.writerow([memory, result])
+
+    def close(self):
+        self.file.close()
+
+
+class GzipCsvResultsWriter(CsvResultsWriter):
+    extension, mime = "csv.gz", "application/gzip"
+
+    @staticmethod
+    def open_file(path):
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+
+
+class XlsxResultsWriter(ResultsWriter):
+    extension, mime = "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    def __init__(self, path, coding_task):
+        super().__init__(path, coding_task)
+        import xlsxwriter  # the writers' libraries are imported only when their format is chosen
+        # constant memory mode flushes every row to disk once the next one is written
+        self.workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        self.worksheet = self.workbook.add_worksheet("Parsed Results")
+        self.worksheet.write_row(0, 0, EXPORT_COLUMNS)
+        self.num_rows = 1
+
+    def write_row(self, memory, result):
+        self.worksheet.write_row(self.num_rows, 0, [memory, result])
+        self.num_rows += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class ParquetResultsWriter(ResultsWriter):
+    """
+    Also writes the parsed codes as columns: the segments of SLV results,
+    or the dimensions' scores of NaCCS results
+    """
+    extension, mime = "parquet", "application/vnd.apache.parquet"
+    SLV_SEGMENT_FIELDS = ["text", "locus", "valence"]
+    COH_FIELDS = ["context", "chronology", "theme", "total", "is_total_consistent"]
+
+    def __init__(self, path, coding_task):
+        super().__init__(path, coding_task)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.record_batch_type = pa.RecordBatch
+        fields = [(column, pa.string()) for column in EXPORT_COLUMNS]
+        if coding_task == SEGMENT_LOCUS_VALENCE:
+            segment_type = pa.struct([(field, pa.string()) for field in self.SLV_SEGMENT_FIELDS])
+            fields.append(("segments", pa.list_(segment_type)))
+        elif coding_task == NARRATIVE_COHERENCE:
+            fields += [(field, pa.int8()) for field in self.COH_FIELDS[:-1]] + [(self.COH_FIELDS[-1], pa.bool_())]
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.rows = []
+
+    def get_parsed_columns(self, result):
+        if self.coding_task == SEGMENT_LOCUS_VALENCE:
+            return {"segments": [{"text": segment.text, "locus": segment.locus, "valence": segment.valence}
+                                 for segment in parse_slv_result(result or "")]}
+        if self.coding_task == NARRATIVE_COHERENCE:
+            scores = parse_coh_result(result or "")
+            return {field: None if scores is None else getattr(scores, field) for field in self.COH_FIELDS}
+        return {}
+
+    def write_row(self, memory, result):
+        self.rows.append({EXPORT_COLUMNS[0]: memory, EXPORT_COLUMNS[1]: result, **self.get_parsed_columns(result)})
+        if len(self.rows) >= EXPORT_PARQUET_ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_batch(self.record_batch_type.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class NpyScoresResultsWriter(ResultsWriter):
+    """
+    Writes only the scores of NaCCS results, as a (num_results, 4) int8 numpy array of the context,
+    chronology, theme and total scores (-1 for malformed results), for analyses that don't need the texts
+    """
+    extension, mime = "npy", "application/octet-stream"
+    coding_tasks = (NARRATIVE_COHERENCE,)
+
+    def __init__(self, path, coding_task):
+        super().__init__(path, coding_task)
+        # the .npy header has the number of rows, so they are written to a temporary file until it is known
+        self.scores_file = tempfile.TemporaryFile()
+        self.num_rows = 0
+
+    def write_row(self, memory, result):
+        self.scores_file.write(bytes(score & 0xFF for score in get_coh_scores(result)))  # int8
+        self.num_rows += 1
+
+    def close(self):
+        import numpy as np
+        header = {"descr": np.lib.format.dtype_to_descr(np.dtype(np.int8)), "fortran_order": False,
+                  "shape": (self.num_rows, 4)}
+        with self.scores_file, open(self.path, "wb") as file:
+            np.lib.format.write_array_header_1_0(file, header)
+            self.scores_file.seek(0)
+            shutil.copyfileobj(self.scores_file, file)
+
+
+class OrderedResultsWriter:
+    """
+    Rows are coded out of order, this writes each one as soon as all the rows before it were written.
+    At most max_pending_rows rows wait for them in memory, the rest wait in a temporary file
+    (e.g. behind a slow or failed row, which is only written by finish).
+    """
+    def __init__(self, writer: ResultsWriter, max_pending_rows=EXPORT_MAX_PENDING_ROWS):
+        self.writer = writer
+        self.max_pending_rows = max_pending_rows
+        self.pending_rows = {}
+        self.spilled_rows = None  # a temporary sqlite database, created when the pending rows are too many
+        self.num_spilled_rows = 0
+        self.next_row_index = 0
+
+    def write(self, row_index, memory, result):
+        if len(self.pending_rows) < self.max_pending_rows or row_index == self.next_row_index:
+            self.pending_rows[row_index] = (memory, result)
+        else:
+            self._spill_row(row_index, memory, result)
+        while (row := self._pop_pending_row(self.next_row_index)) is not None:
+            self.writer.write_row(*row)
+            self.next_row_index += 1
+
+    def _spill_row(self, row_index, memory, result):
+        if self.spilled_rows is None:
+            self.spilled_rows = sqlite3.connect("")  # a temporary file, deleted when it is closed
+            self.spilled_rows.execute("CREATE TABLE rows (row_index INTEGER PRIMARY KEY, memory TEXT, result TEXT)")
+        self.spilled_rows.execute("INSERT INTO rows VALUES (?, ?, ?)", (row_index, memory, result))
+        self.num_spilled_rows += 1
+
+    def _pop_pending_row(self, row_index):
+        """
+        :return: the (memory, result) of the row if it is pending, otherwise None
+        """
+        if row_index in self.pending_rows:
+            return self.pending_rows.pop(row_index)
+        if not self.num_spilled_rows:
+            return None
+        row = self.spilled_rows.execute("SELECT memory, result FROM rows WHERE row_index = ?", (row_index,)).fetchone()
+        if row is not None:
+            self.spilled_rows.execute("DELETE FROM rows WHERE row_index = ?", (row_index,))
+            self.num_spilled_rows -= 1
+        return row
+
+    def _close_spilled_rows(self):
+        if self.spilled_rows is not None:
+            self.spilled_rows.close()
+            self.spilled_rows, self.num_spilled_rows = None, 0
+
+    def finish(self, memories, results, num_rows=None):
+        """
+        Writes the rows that were never written (e.g. failed ones), closes the file and returns its path
+        :param memories: and results, lists of all the rows, or {row_index: value} dicts of the rows that were
+                         never written (then num_rows is required)
+        """
+        for row_index in range(self.next_row_index, len(memories) if num_rows is None else num_rows):
+            row = self._pop_pending_row(row_index)
+            memory, result = row if row is not None else (memories[row_index], results[row_index])
+            self.writer.write_row(memory, "" if result is None else result)
+        self._close_spilled_rows()
+        self.writer.close()
+        return self.writer.path
+
+    def discard(self):
+        self._close_spilled_rows()
+        self.writer.close()
+        os.remove(self.writer.path)
+
+
+RESULTS_WRITERS = {"TXT": TxtResultsWriter, "CSV": CsvResultsWriter, "CSV (gzip)": GzipCsvResultsWriter,
+                   "XLSX": XlsxResultsWriter, "Parquet": ParquetResultsWriter,
+                   "NumPy scores": NpyScoresResultsWriter}
+
+
+def get_output_format(path):
+    """
+    :return: the output format of the path's extension, None if it has no results writer
+    """
+    for output_format, writer_class in RESULTS_WRITERS.items():
+        if path.lower().endswith(f".{writer_class.extension}"):
+            return output_format
+    return None
+
+
+def create_results_writer(output_format, coding_task, path=None):
+    """
+    :param path: where to write the results, a new temporary file by default
+    """
+    writer_class = RESULTS_WRITERS[output_format]
+    if path is None:
+        file_descriptor, path = tempfile.mkstemp(prefix="results_", suffix=f".{writer_class.extension}")
+        os.close(file_descriptor)
+    return OrderedResultsWriter(writer_class(path, coding_task))
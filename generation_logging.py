@@ -0,0 +1,179 @@
+import json
+import queue
+import atexit
+import logging
+import sqlite3
+import threading
+from instrumentation import span
+from process_wide import process_wide
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationLogSink:
+    """
+    A destination for generation logs, which only ever appends new rows
+    (so the cost of writing doesn't depend on the size of the log history)
+    """
+    def append(self, logs: list[dict[str, str]]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonlLogSink(GenerationLogSink):
+    def __init__(self, path=LOCAL_GENERATION_LOG_JSONL_PATH):
+        self.path = path
+
+    def append(self, logs):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(log, ensure_ascii=False) + "\n" for log in logs)
+
+
+class SqliteLogSink(GenerationLogSink):
+    def __init__(self, path=LOCAL_GENERATION_LOG_SQLITE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        columns = ", ".join(f'"{column}" TEXT' for column in GENERATION_LOG_COLUMNS)
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS generation_log ({columns})")
+        existing_columns = {row[1] for row in self.connection.execute("PRAGMA table_info(generation_log)")}
+        for column in GENERATION_LOG_COLUMNS:  # logs created before a column was added
+            if column not in existing_columns:
+                self.connection.execute(f'ALTER TABLE generation_log ADD COLUMN "{column}" TEXT')
+        self.connection.commit()
+
+    def append(self, logs):
+        columns = ", ".join(f'"{column}"' for column in GENERATION_LOG_COLUMNS)
+        placeholders = ", ".join("?" * len(GENERATION_LOG_COLUMNS))
+        rows = [[log.get(column) for column in GENERATION_LOG_COLUMNS] for log in logs]
+        with self.connection:  # commits once for the whole batch
+            self.connection.executemany(f"INSERT INTO generation_log ({columns}) VALUES ({placeholders})", rows)
+
+    def close(self):
+        self.connection.close()
+
+
+class GSheetsLogSink(GenerationLogSink):
+    """
+    Appends rows at the end of the log worksheet, without downloading it first
+    """
+    def __init__(self, conn):
+        if not hasattr(conn.client, "_select_worksheet"):  # e.g. a public (read-only) spreadsheet
+            raise ValueError("The generation logs can only be appended to the G-Sheet with a service account")
+        self.worksheet = conn.client._select_worksheet()  # the gspread worksheet behind the connection
+        # rows are written in the order of the sheet's header, extended with the columns added since it was created
+        header = self.worksheet.row_values(1)
+        self.columns = header + [column for column in GENERATION_LOG_COLUMNS if column not in header]
+        if self.columns != header:
+            if len(self.columns) > self.worksheet.col_count:
+                self.worksheet.add_cols(len(self.columns) - self.worksheet.col_count)
+            self.worksheet.update("A1", [self.columns], value_input_option="RAW")
+
+    @staticmethod
+    def get_cell(value):
+        cell = "" if value is None else str(value)
+        if len(cell) > GSHEETS_MAX_CELL_CHARS:  # otherwise the whole batch is rejected
+            cell = cell[:GSHEETS_MAX_CELL_CHARS - len(GSHEETS_TRUNCATED_CELL_SUFFIX)] + GSHEETS_TRUNCATED_CELL_SUFFIX
+        return cell
+
+    def append(self, logs):
+        rows = [[self.get_cell(log.get(column)) for column in self.columns] for log in logs]
+        self.worksheet.append_rows(rows, value_input_option="RAW")
+
+
+class BufferedLogSink(GenerationLogSink):
+    """
+    Buffers logs in memory and flushes them in bulk to another sink from a background thread,
+    so the caller (usually the UI thread) never waits for the actual write.
+    A batch that still fails after max_retries is written to the fallback sink, so it doesn't hold back the next ones.
+    """
+    def __init__(self, sink: GenerationLogSink, flush_interval=GENERATION_LOG_FLUSH_INTERVAL_SECONDS,
+                 max_batch_size=GENERATION_LOG_MAX_BATCH_SIZE, max_retries=GENERATION_LOG_MAX_RETRIES,
+                 fallback_sink: GenerationLogSink = None):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.fallback_sink = fallback_sink or JsonlLogSink(GENERATION_LOG_FALLBACK_JSONL_PATH)
+        self.queue = queue.Queue()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._flush_loop, daemon=True,
+                                       name="generation-log-flusher")
+        self.thread.start()
+
+    def append(self, logs):
+        for log in logs:
+            self.queue.put(log)
+
+    def _take_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout))
+            while len(batch) < self.max_batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _flush_loop(self):
+        while not (self.closed.is_set() and self.queue.empty()):
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        for retry in range(self.max_retries + 1):
+            try:
+                with span(LOG_SINK_WRITE_SPAN, sink=type(self.sink).__name__, num_logs=len(batch), retry=retry):
+                    self.sink.append(batch)
+                return
+            except Exception as e:  # never lose the logs because of a temporary failure
+                error = e
+            if retry < self.max_retries:
+                self.closed.wait(self.flush_interval * (retry + 1))
+        logger.warning("Failed to write %d generation logs after %d retries, writing them to %s instead: %s",
+                       len(batch), self.max_retries, type(self.fallback_sink).__name__, error)
+        try:
+            self.fallback_sink.append(batch)
+        except Exception:
+            logger.exception("Failed to write %d generation logs to the fallback sink", len(batch))
+
+    def close(self, timeout=GENERATION_LOG_CLOSE_TIMEOUT_SECONDS):
+        self.closed.set()
+        self.thread.join(timeout)
+        self.sink.close()
+
+
+def get_default_log_sink_type():
+    return GENERATION_LOG_SINK_TYPE if is_running_in_streamlit() else HEADLESS_GENERATION_LOG_SINK_TYPE
+
+
+def create_generation_log_sink(sink_type=None):
+    sink_type = sink_type or get_default_log_sink_type()
+    if sink_type == JSONL_LOG_SINK:
+        return JsonlLogSink()
+    if sink_type == SQLITE_LOG_SINK:
+        return SqliteLogSink()
+    # sink_type == GSHEETS_LOG_SINK
+    return GSheetsLogSink(get_gsheets_connection())
+
+
+@process_wide
+def get_generation_log_sink():
+    """
+    The buffered sink that all the generation logs are saved to by default
+    """
+    sink = BufferedLogSink(create_generation_log_sink())
+    atexit.register(sink.close)
+    return sink
+
+
+def set_generation_log_sink(sink: GenerationLogSink):
+    """
+    Replaces the default sink (e.g. with a local one, for benchmarks), closing the previous one
+    """
+    previous_sink = get_generation_log_sink.replace((), sink)
+    if previous_sink is not None:
+        previous_sink.close()
@@ -0,0 +1,44 @@
+import re
+from functools import lru_cache
+from process_wide import process_wide
+from constants import *
+
+
+class CodeHighlighter:
+    """
+    Formats all the codes of a coding task in a single pass over the text,
+    with one regex compiled from the task's formatted codes dict.
+    Rendered texts are memoized, so re-displaying the same messages (e.g. the chat history
+    on every rerun) doesn't format them again.
+    """
+    def __init__(self, formatted_codes: dict[str, str]):
+        self.formatted_codes = dict(formatted_codes)
+        # longest codes first, so a code is never shadowed by another code that is its prefix
+        codes = sorted(self.formatted_codes, key=len, reverse=True)
+        self.pattern = re.compile("|".join(map(re.escape, codes))) if codes else None
+        self.highlight = lru_cache(maxsize=HIGHLIGHT_CACHE_SIZE)(self._highlight)
+        self.code_prefixes = {code[:i] for code in codes for i in range(1, len(code))}
+        self.max_code_length = max(map(len, codes), default=0)
+
+    def _replace(self, match):
+        return self.formatted_codes[match.group(0)]
+
+    def _highlight(self, text: str):
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self._replace, text)
+
+    def highlight_partial(self, text: str):
+        """
+        Highlights text that is still being generated (not memoized), holding back its end
+        if it might be the beginning of a code, so codes only show up once they are complete
+        """
+        for length in range(min(self.max_code_length - 1, len(text)), 0, -1):
+            if text[-length:] in self.code_prefixes:
+                return self._highlight(text[:-length])
+        return self._highlight(text)
+
+
+@process_wide(key=id)  # the formatted codes dicts are module level constants, so their id identifies them
+def get_highlighter(formatted_codes: dict[str, str]):
+    return CodeHighlighter(formatted_codes)
@@ -0,0 +1,49 @@
+import io
+from constants import *
+
+
+def iter_text_memories(file, encoding="utf-8"):
+    """
+    Yields the non-empty lines of a binary file one by one, without decoding it all at once
+    """
+    text_file = io.TextIOWrapper(file, encoding=encoding)
+    try:
+        for line in text_file:
+            if line.strip():
+                yield line.strip()
+    finally:
+        text_file.detach()  # otherwise closing the wrapper closes the (uploaded) file too
+
+
+def iter_csv_memories(file):
+    # reads only the first column (the memories), chunk by chunk
+    import pandas as pd  # imported only when a file of its format is uploaded, like openpyxl
+    for chunk in pd.read_csv(file, usecols=[0], chunksize=INGESTION_CSV_CHUNK_SIZE):
+        yield from chunk.iloc[:, 0].dropna().astype(str)
+
+
+def iter_xlsx_memories(file):
+    # read-only mode loads the rows lazily instead of the whole workbook
+    from openpyxl import load_workbook
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        # the first sheet (like pd.read_excel), not the one that was active when the file was saved
+        rows = workbook.worksheets[0].iter_rows(min_row=2, max_col=1, values_only=True)  # skips the header
+        for (memory,) in rows:
+            if memory is not None:
+                yield str(memory)
+    finally:
+        workbook.close()
+
+
+def iter_uploaded_memories(uploaded_file):
+    """
+    :return: the input format of the file, and a lazy iterator over its memories
+    """
+    uploaded_file.seek(0)
+    if uploaded_file.name.endswith(".csv"):
+        return "CSV", iter_csv_memories(uploaded_file)
+    if uploaded_file.name.endswith(".xlsx"):
+        return "XLSX", iter_xlsx_memories(uploaded_file)
+    # ends with ".txt"
+    return "TXT", iter_text_memories(uploaded_file)
@@ -0,0 +1,109 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict, deque
+from constants import *
+
+_local = threading.local()  # the open spans, and the spans collected for a generation log, of every thread
+_stats_lock = threading.Lock()
+_durations = defaultdict(lambda: deque(maxlen=SPAN_STATS_WINDOW))  # the recent durations of each stage
+_counts = defaultdict(int)
+_trace_file = None
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the code in the with block as the stage `name`, with optional attributes
+    (more can be added from inside the block, see set_span_attributes)
+    """
+    record = {SPAN_NAME: name, **attributes}
+    open_spans = _local.__dict__.setdefault("open_spans", [])
+    open_spans.append(record)
+    start_time, start = time.time(), time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record[SPAN_ERROR] = type(e).__name__
+        raise
+    finally:
+        record[SPAN_DURATION_MS] = round((time.perf_counter() - start) * 1000, 3)
+        open_spans.pop()
+        _finish_span(record, start_time)
+
+
+def set_span_attributes(**attributes):
+    # adds the attributes to the innermost open span of the thread, if there is one
+    open_spans = getattr(_local, "open_spans", None)
+    if open_spans:
+        open_spans[-1].update(attributes)
+
+
+@contextmanager
+def collect_spans():
+    """
+    :return: a list, that is filled with all the spans the thread finishes inside the with block
+    """
+    previous_spans = getattr(_local, "collected_spans", None)
+    _local.collected_spans = spans = []
+    try:
+        yield spans
+    finally:
+        _local.collected_spans = previous_spans
+
+
+def add_collected_spans(spans):
+    # adds spans finished by another thread (e.g. a generation it ran for this one) to the thread's collected spans
+    collected_spans = getattr(_local, "collected_spans", None)
+    if collected_spans is not None:
+        collected_spans.extend(spans)
+
+
+def _finish_span(record, start_time):
+    collected_spans = getattr(_local, "collected_spans", None)
+    if collected_spans is not None:
+        collected_spans.append(record)
+    with _stats_lock:
+        _durations[record[SPAN_NAME]].append(record[SPAN_DURATION_MS])
+        _counts[record[SPAN_NAME]] += 1
+        if _trace_file is not None:
+            _trace_file.write(json.dumps({"timestamp": start_time, "thread": threading.current_thread().name,
+                                          **record}, ensure_ascii=False) + "\n")
+
+
+def get_span_stats():
+    """
+    :return: {stage: {count, mean, p50, p95 and max milliseconds}}, of the last SPAN_STATS_WINDOW spans of each stage
+    """
+    with _stats_lock:
+        durations = {name: sorted(name_durations) for name, name_durations in _durations.items()}
+        counts = dict(_counts)
+    return {name: {"count": counts[name],
+                   "mean_ms": round(sum(name_durations) / len(name_durations), 3),
+                   "p50_ms": name_durations[len(name_durations) // 2],
+                   "p95_ms": name_durations[min(len(name_durations) - 1, int(len(name_durations) * 0.95))],
+                   "max_ms": name_durations[-1]}
+            for name, name_durations in durations.items()}
+
+
+def reset_span_stats():
+    with _stats_lock:
+        _durations.clear()
+        _counts.clear()
+
+
+def set_trace_path(path=TRACE_FILE_PATH):
+    """
+    Starts exporting every finished span as a JSON line to the local file, or stops it if path is None
+    """
+    global _trace_file
+    with _stats_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = open(path, "a", encoding="utf-8", buffering=1) if path else None
+
+
+def get_trace_path():
+    with _stats_lock:
+        return _trace_file.name if _trace_file is not None else None
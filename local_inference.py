@@ -0,0 +1,223 @@
+"""
+The LOCAL_SERVICE: small instruction models that run on the CPU of this machine (with transformers),
+so memories can be coded offline, without network latency or provider quotas.
+Its client (see LocalClient) looks like the OpenAI SDK's client to raw_generation and the streaming functions.
+"""
+import copy
+import time
+import queue
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future
+
+from process_wide import process_wide
+from constants import *
+
+# the parts of the OpenAI SDK's responses that are read by prompting.py and main.py
+LocalMessage = namedtuple("LocalMessage", ["content"])
+LocalChoice = namedtuple("LocalChoice", ["message", "finish_reason", "delta"], defaults=[None])
+LocalUsage = namedtuple("LocalUsage", ["prompt_tokens", "completion_tokens"])
+LocalCompletion = namedtuple("LocalCompletion", ["choices", "usage"])
+
+# a request waiting for the batcher, the streamer is a TextIteratorStreamer for stream=True requests,
+# stop is a tuple of stop sequences
+LocalRequest = namedtuple("LocalRequest", ["messages", "max_tokens", "temperature", "future", "streamer", "stop"],
+                          defaults=[()])
+
+
+class LocalModel:
+    """
+    A local model and its tokenizer (slow to load, see get_local_model), with the KV cache of the recent
+    system prompts, so their tokens are computed once and not with every memory
+    """
+    def __init__(self, model_name):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        torch.set_num_threads(LOCAL_NUM_THREADS or torch.get_num_threads())
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch.float32)
+        self.model.eval()
+        self.prefix_caches = OrderedDict()  # {prefix text: (token ids, KV cache)}, least recently used first
+
+    def split_prompt(self, messages):
+        """
+        :return: the prompt's prefix (the system prompt, shared by all the memories) and the rest of it
+        """
+        prompt = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        if messages[0]["role"] != "system":
+            return "", prompt
+        prefix = self.tokenizer.apply_chat_template(messages[:1], tokenize=False)
+        if not prompt.startswith(prefix):  # e.g. a template that merges the system prompt into the first message
+            return "", prompt
+        return prefix, prompt[len(prefix):]
+
+    def get_prefix_cache(self, prefix):
+        if prefix in self.prefix_caches:
+            self.prefix_caches.move_to_end(prefix)
+            return self.prefix_caches[prefix]
+        prefix_ids = self.tokenizer(prefix, add_special_tokens=False).input_ids
+        with self.torch.no_grad():
+            cache = self.model(input_ids=self.torch.tensor([prefix_ids]), use_cache=True).past_key_values
+        self.prefix_caches[prefix] = (prefix_ids, cache)
+        if len(self.prefix_caches) > LOCAL_PREFIX_CACHE_SIZE:
+            self.prefix_caches.popitem(last=False)
+        return prefix_ids, cache
+
+    def generate(self, prefix, suffixes, max_tokens, temperature, streamer=None, stop=()):
+        """
+        Generates the answers of all the prompts (that share the prefix) in a single padded batch.
+        The padding is between the prefix and every suffix, so the prefix's cached keys and values fit all of them.
+        :param stop: stop sequences, which (like the model services) end the output and aren't part of it
+        :return: list of (output, finish_reason, prompt_tokens, completion_tokens), in the order of suffixes
+        """
+        torch = self.torch
+        suffixes_ids = [self.tokenizer(suffix, add_special_tokens=False).input_ids for suffix in suffixes]
+        prefix_ids, cache = self.get_prefix_cache(prefix) if prefix else ([], None)
+        suffix_length = max(map(len, suffixes_ids))
+        pad_token_id = self.tokenizer.pad_token_id
+        input_ids = [prefix_ids + [pad_token_id] * (suffix_length - len(ids)) + ids for ids in suffixes_ids]
+        attention_mask = [[1] * len(prefix_ids) + [0] * (suffix_length - len(ids)) + [1] * len(ids)
+                          for ids in suffixes_ids]
+        generation_kwargs = {"max_new_tokens": max_tokens, "pad_token_id": pad_token_id, "streamer": streamer,
+                             "do_sample": temperature > 0}
+        if temperature > 0:
+            generation_kwargs["temperature"] = temperature
+        if stop:
+            generation_kwargs.update(stop_strings=list(stop), tokenizer=self.tokenizer)
+        if cache is not None:
+            cache = copy.deepcopy(cache)  # generate extends it
+            cache.batch_repeat_interleave(len(suffixes))
+            generation_kwargs["past_key_values"] = cache
+        with torch.no_grad():
+            output_ids = self.model.generate(input_ids=torch.tensor(input_ids),
+                                             attention_mask=torch.tensor(attention_mask), **generation_kwargs)
+        eos_token_ids = self.model.generation_config.eos_token_id
+        eos_token_ids = set(eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids])
+        generations = []
+        for ids, new_ids in zip(suffixes_ids, output_ids[:, len(input_ids[0]):].tolist()):
+            completion_length = next((i for i, token_id in enumerate(new_ids) if token_id in eos_token_ids), None)
+            finish_reason = "stop" if completion_length is not None else FINISH_REASON_LENGTH
+            if completion_length is None:
+                completion_length = len(new_ids)
+            output = self.tokenizer.decode(new_ids[:completion_length], skip_special_tokens=True)
+            stop_index = min((output.find(sequence) for sequence in stop if sequence in output), default=None)
+            if stop_index is not None:
+                output, finish_reason = output[:stop_index], "stop"
+                completion_length = len(self.tokenizer(output, add_special_tokens=False).input_ids)
+            generations.append((output, finish_reason, len(prefix_ids) + len(ids), completion_length))
+        return generations
+
+
+@process_wide  # loaded on its first use
+def get_local_model(model_name):
+    return LocalModel(model_name)
+
+
+class LocalGenerationBatcher:
+    """
+    Collects the requests of the batch workers (see batch_coding.py) for up to LOCAL_BATCH_WAIT_SECONDS,
+    and generates the ones with the same system prompt and generation parameters in a single padded batch,
+    from a single thread (the model already uses all the CPU cores for a single batch)
+    """
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name=f"local_generation_{model_name}", daemon=True)
+        self.worker.start()
+
+    def submit(self, request: LocalRequest):
+        self.requests.put(request)
+        return request.future
+
+    def _collect_requests(self):
+        requests = [self.requests.get()]
+        deadline = time.monotonic() + LOCAL_BATCH_WAIT_SECONDS
+        while len(requests) < LOCAL_MAX_BATCH_SIZE:
+            try:
+                requests.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect_requests()
+            try:
+                model = get_local_model(self.model_name)
+            except Exception as e:
+                for request in requests:
+                    self._fail(request, e)
+                continue
+            batches = {}
+            for request in requests:
+                try:
+                    prefix, suffix = model.split_prompt(request.messages)
+                except Exception as e:  # e.g. messages the model's chat template doesn't allow
+                    self._fail(request, e)
+                    continue
+                if request.streamer is not None:  # streamed alone, as soon as possible
+                    self._generate(model, prefix, [(request, suffix)], request.streamer)
+                    continue
+                batches.setdefault((prefix, request.max_tokens, request.temperature, request.stop),
+                                   []).append((request, suffix))
+            for (prefix, _, _, _), batch in batches.items():
+                self._generate(model, prefix, batch)
+
+    @staticmethod
+    def _fail(request, error):
+        if request.streamer is not None:
+            request.streamer.end()  # otherwise the caller waits for its text forever
+        request.future.set_exception(error)
+
+    def _generate(self, model, prefix, batch, streamer=None):
+        first_request = batch[0][0]
+        try:
+            generations = model.generate(prefix, [suffix for _, suffix in batch], first_request.max_tokens,
+                                         first_request.temperature, streamer, first_request.stop)
+        except Exception as e:
+            for request, _ in batch:
+                self._fail(request, e)
+            return
+        for (request, _), generation in zip(batch, generations):
+            request.future.set_result(generation)
+
+
+@process_wide
+def get_local_batcher(model_name):
+    return LocalGenerationBatcher(model_name)
+
+
+class LocalClient:
+    """
+    A client of the LOCAL_SERVICE models, with the OpenAI SDK's client.chat.completions.create
+    """
+    def __init__(self):
+        self.chat = self.completions = self  # client.chat.completions.create is self.create
+
+    def create(self, model, messages, max_tokens=MAX_TOKENS_DEFAULT, temperature=DEFAULT_TEMPERATURE, stream=False,
+               stop=None, **kwargs):
+        stop = (stop,) if isinstance(stop, str) else tuple(stop or ())
+        streamer = None
+        if stream:
+            from transformers import TextIteratorStreamer
+            local_model = get_local_model(model)  # the streamer needs the tokenizer
+            streamer = TextIteratorStreamer(local_model.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        future = get_local_batcher(model).submit(LocalRequest(messages, max_tokens, temperature, Future(), streamer,
+                                                              stop))
+        if stream:
+            return self._iter_chunks(streamer, future)
+        output, finish_reason, prompt_tokens, completion_tokens = future.result()
+        return LocalCompletion([LocalChoice(LocalMessage(output), finish_reason)],
+                               LocalUsage(prompt_tokens, completion_tokens))
+
+    @staticmethod
+    def _iter_chunks(streamer, future):
+        for text in streamer:
+            if text:
+                yield LocalCompletion([LocalChoice(None, None, LocalMessage(text))], None)
+        _, finish_reason, prompt_tokens, completion_tokens = future.result()  # raises the generation's error
+        yield LocalCompletion([LocalChoice(None, finish_reason, LocalMessage(None))],
+                              LocalUsage(prompt_tokens, completion_tokens))
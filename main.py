@@ -1,11 +1,23 @@
+import os
+import time
+import queue
 import streamlit as st
-import pandas as pd
 from pathlib import Path
-from io import BytesIO
-
-from prompting import get_system_prompt, code_text, save_generation_log, \
-    generate_for_chat_with_write_stream
-from constants import *  # includes st
+from collections import deque
+
+from coder import Coder
+from prompting import GenerationResult, reload_private_examples, raw_stream_generation, \
+    get_streaming_generation_func, get_private_examples
+from batch_jobs import get_batch_job_checkpoint
+from response_cache import get_response_cache
+from highlighting import get_highlighter
+from scheduling import get_all_schedulers_stats
+from routing import get_router
+from instrumentation import span, set_span_attributes, get_span_stats, reset_span_stats, set_trace_path, \
+    get_trace_path
+from ingestion import iter_uploaded_memories
+from exporting import create_results_writer
+from constants import *
 
 
 def get_list_of_lines_from_file(file_name):
@@ -85,10 +97,35 @@ def home_page():
     st.caption(CONTACT_SUPPORT_MESSAGE)
 
 
+def get_session_coder(warning_callback=st.warning):
+    """
+    The coder of the session's model configuration and user, showing its warnings on the page
+    :param warning_callback: st.warning by default, which only works from the script thread
+                             (see show_queued_warnings for the batch workers' warnings)
+    """
+    return Coder(validate_model_config(), api_key=st.secrets["HF_API_KEY"],
+                 user=st.session_state.get("user", "error"), warning_callback=warning_callback,
+                 examples_loader=get_private_examples)
+
+
+def show_queued_warnings(warnings: queue.SimpleQueue, warnings_area, shown_warnings: set):
+    """
+    Shows the warnings the batch workers queued, from the script thread (streamlit elements can't be added
+    from other threads), each message only once
+    """
+    while True:
+        try:
+            message = warnings.get_nowait()
+        except queue.Empty:
+            return
+        if message not in shown_warnings:
+            shown_warnings.add(message)
+            warnings_area.warning(message)
+
+
 def format_coded_result(result, formatted_codes):
-    for code, formatted_code in formatted_codes.items():
-        result = result.replace(code, formatted_code)
-    return result
+    with span(HIGHLIGHT_SPAN, length=len(result)):
+        return get_highlighter(formatted_codes).highlight(result)
 
 
 def get_coding_task_formatted_codes():
@@ -102,17 +139,19 @@ def single_memory_page():
     show_current_config_info()
     memory_text = st.text_area("Paste the memory you want to code")
     if st.button("Code") and memory_text:
+        st.subheader("Coded result &mdash; color coded and highlighted")
+        formatted_codes, color_coding_legend = get_coding_task_formatted_codes()
+        st.caption(f"{GENERAL_COLOR_CODING_LEGEND_TITLE} {color_coding_legend}")
+        highlighted_result = st.empty()  # shows the result while it is generated
+        highlighter = get_highlighter(formatted_codes)
+        streaming_generation = get_streaming_generation_func(
+            lambda text: highlighted_result.markdown(highlighter.highlight_partial(text)))
         try:
-            with st.spinner("Model generating your coded result..."):
-                result, message_history, generation_log = code_text(memory_text)
-                save_generation_log(single_generation_log=generation_log)
+            result, _ = get_session_coder().code(memory_text, generation_func=streaming_generation)
         except Exception as e:
             handle_generation_error(e)
         else:
-            st.subheader("Coded result &mdash; color coded and highlighted")
-            formatted_codes, color_coding_legend = get_coding_task_formatted_codes()
-            st.caption(f"{GENERAL_COLOR_CODING_LEGEND_TITLE} {color_coding_legend}")
-            st.markdown(format_coded_result(result, formatted_codes))
+            highlighted_result.markdown(format_coded_result(result, formatted_codes))
             st.subheader("Coded result &mdash; as plain text with copy button")
             st.code(result, language=None)  # using st.code to have a built-in copy button
     page_bottom()
@@ -130,72 +169,114 @@ def multiple_memories_page():
     show_current_config_info()
 
     input_mode = st.radio("Choose input method", ["Paste text", "Upload file"])
-    memories = []
+    memories, input_content = [], b""
 
     if input_mode == "Paste text":
         multi_text = st.text_area("Paste multiple memories, separated by line breaks")
         if multi_text:
             memories = [line.strip() for line in multi_text.splitlines() if line.strip()]
+            input_content = multi_text.encode("utf-8")
         input_format = "Plain text"
     else:  # input_mode == "Upload file":
         uploaded_file = st.file_uploader("Upload a TXT, CSV, or XLSX file",
                                          type=["txt", "csv", "xlsx"])
         if uploaded_file:
-            if uploaded_file.name.endswith(".csv"):
-                df = pd.read_csv(uploaded_file)
-                memories = df.iloc[:, 0].dropna().astype(str).tolist()
-                input_format = "CSV"
-            elif uploaded_file.name.endswith(".xlsx"):
-                df = pd.read_excel(uploaded_file)
-                memories = df.iloc[:, 0].dropna().astype(str).tolist()
-                input_format = "XLSX"
-            else:  # ends with ".txt"
-                content = uploaded_file.read().decode("utf-8")
-                memories = [line.strip() for line in content.splitlines() if line.strip()]
-                input_format = "TXT"
-
-    output_format = st.radio("Choose output format",
-                             ["Same as input", "Plain text", "TXT", "CSV", "XLSX"], index=0)
+            # memories are read lazily, while they are being coded
+            input_format, memories = iter_uploaded_memories(uploaded_file)
+            input_content = uploaded_file.getvalue()
+
+    output_formats = ["Same as input", "Plain text", "TXT", "CSV", "CSV (gzip)", "XLSX", "Parquet"]
+    if validate_model_config()[CODING_TASK] == NARRATIVE_COHERENCE:
+        output_formats.append("NumPy scores")
+    output_format = st.radio("Choose output format", output_formats, index=0)
+    max_workers = st.number_input("Number of memories to code in parallel",
+                                  min_value=1, max_value=BATCH_MAX_WORKERS_LIMIT,
+                                  value=BATCH_MAX_WORKERS_DEFAULT)
+    pack_size = st.number_input("Number of memories to code in a single request "
+                                "(fewer requests, but the model might need to re-code some alone)",
+                                min_value=1, max_value=PACKED_MEMORIES_LIMIT,
+                                value=PACKED_MEMORIES_DEFAULT)
+    use_cache = st.checkbox("Reuse results of memories that were already coded with this configuration",
+                            value=True)
+    resume_job = st.checkbox("Resume an interrupted run of the same input with this configuration",
+                             value=True)
 
     if st.button("Code Memories") and memories:
+        if output_format == "Same as input":
+            output_format = input_format
+        import pandas as pd  # for the results tables, only this page needs it
+        results_writer = None  # results are written to the output file while they are coded
+        if output_format != "Plain text":
+            results_writer = create_results_writer(output_format, validate_model_config()[CODING_TASK])
+        warnings, warnings_area, shown_warnings = queue.SimpleQueue(), st.container(), set()
         try:
             with st.spinner("Model generating your coded results..."):
-                progress_bar = st.progress(0, text=f"Coding {len(memories)} memories")
-                messages = [{"role": "system", "content": get_system_prompt()}]  # save process time
-                results, logs = [], []
-                for i, memory in enumerate(memories):
-                    result, message_history, generation_log = code_text(memory, messages)
-                    relative_progress = (i + 1) / len(memories)
+                progress_bar = st.progress(0, text="Coding memories")
+                live_results = st.empty()  # the latest coded memories, shown while the rest are coded
+                live_rows = deque(maxlen=LIVE_RESULTS_MAX_ROWS)
+                last_render = [0]
+                num_read_memories = [0]
+
+                def on_row_coded(row_index, memory, result):
+                    show_queued_warnings(warnings, warnings_area, shown_warnings)
+                    if results_writer:
+                        results_writer.write(row_index, memory, result)
+                    live_rows.append((row_index + 1, memory, result))
+                    if time.monotonic() - last_render[0] >= STREAM_RENDER_INTERVAL_SECONDS:
+                        live_results.dataframe(pd.DataFrame(list(live_rows), columns=["Row"] + EXPORT_COLUMNS),
+                                               hide_index=True)
+                        last_render[0] = time.monotonic()
+
+                def update_progress(num_coded, num_memories):
+                    show_queued_warnings(warnings, warnings_area, shown_warnings)
+                    num_read_memories[0] = num_memories or 0
+                    if num_memories is None:  # still reading the uploaded file
+                        relative_progress = min(uploaded_file.tell() / max(uploaded_file.size, 1), 1)
+                        progress_bar.progress(relative_progress,
+                                              text=f"Coded {num_coded} memories (~{relative_progress * 100:.1f}% of the file)")
+                        return
+                    relative_progress = num_coded / num_memories
                     progress_bar.progress(relative_progress,
-                                          text=f"Coded {i + 1} of {len(memories)} memories ({relative_progress * 100:.1f}%)")
-                    results.append(result)
-                    logs.append(generation_log)
+                                          text=f"Coded {num_coded} of {num_memories} memories ({relative_progress * 100:.1f}%)")
+
+                coder = get_session_coder(warning_callback=warnings.put)  # called from the batch workers
+                job_id = coder.get_batch_job_id(input_content)
+                if not resume_job:
+                    get_batch_job_checkpoint().clear(job_id)
+                # only the plain text output shows all the results at once, files are written while coding
+                memories, results, _, failed_rows = coder.run_batch_job(
+                    job_id, memories, max_workers=max_workers, pack_size=pack_size, progress_callback=update_progress,
+                    row_callback=on_row_coded, use_cache=use_cache, keep_results=output_format == "Plain text")
                 progress_bar.empty()
-                save_generation_log(multiple_generation_logs=logs)
+                live_results.empty()
         except Exception as e:
+            show_queued_warnings(warnings, warnings_area, shown_warnings)
+            if results_writer:
+                results_writer.discard()
             handle_generation_error(e)
         else:
-            if output_format == "Same as input":
-                output_format = input_format
+            show_queued_warnings(warnings, warnings_area, shown_warnings)
+            if failed_rows:
+                st.warning(f"Failed to code {len(failed_rows)} of {num_read_memories[0]} memories "
+                           f"(their results are left empty, or malformed). Running this input again "
+                           f"will only retry them. The first error was:")
+                st.error(next(iter(failed_rows.values())))
             if output_format == "Plain text":
                 st.subheader("Results")
-                displayed_results = "\n".join([f"{result}" for result in results])
+                displayed_results = "\n".join(["" if result is None else f"{result}" for result in results])
                 st.code(displayed_results, language=None)  # same reason for st.code from previous
             else:
-                df = pd.DataFrame({"Input": memories, "Parsed Result": results})
-                if output_format == "CSV":
-                    csv = df.to_csv(index=False).encode("utf-8")
-                    st.download_button("Download CSV", csv, "results.csv", "text/csv")
-                elif output_format == "XLSX":
-                    xlsx_buffer = BytesIO()
-                    with pd.ExcelWriter(xlsx_buffer, engine="xlsxwriter") as writer:
-                        df.to_excel(writer, index=False, sheet_name="Parsed Results")
-                    st.download_button("Download XLSX", xlsx_buffer.getvalue(), "results.xlsx",
-                                       "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                elif output_format == "TXT":
-                    txt = "\n".join(results).encode("utf-8")
-                    st.download_button("Download TXT", txt, "results.txt", "text/plain")
-                st.dataframe(df)
+                results_path = results_writer.finish(memories, results, num_read_memories[0])
+                writer_class = type(results_writer.writer)
+                with open(results_path, "rb") as results_file:
+                    st.download_button(f"Download {output_format}", results_file,
+                                       f"results.{writer_class.extension}", writer_class.mime)
+                os.remove(results_path)
+                # a preview of the last coded memories, all of them are in the file
+                st.caption(f"The last {len(live_rows)} coded memories (all of them are in the downloaded file):")
+                st.dataframe(pd.DataFrame(list(live_rows), columns=["Row"] + EXPORT_COLUMNS), hide_index=True)
+            if not failed_rows:  # the job is done and its results exported, so there is nothing to resume
+                get_batch_job_checkpoint().clear(job_id)
 
     page_bottom()
 
@@ -237,6 +318,30 @@ def show_current_config_info():
     st.info(f"{config_ifo_message}\n{MODIFY_CONFIG_INSTRUCTION}")
 
 
+def join_write_stream(stream, request_start):
+    content_parts = []
+    def generator():
+        for chunk in stream:
+            try:
+                content = chunk.choices[0].delta.content  # TODO: consider using chunk.choices[0].finish_reason == "length"
+                if content:
+                    if not content_parts:
+                        set_span_attributes(**{TIME_TO_FIRST_TOKEN_MS: round((time.perf_counter() - request_start) * 1000, 3)})
+                    content_parts.append(content)
+                    yield content
+            except (AttributeError, IndexError, KeyError):
+                # Skip malformed chunks
+                continue
+    st.write_stream(generator())
+    return "".join(content_parts)
+
+
+def write_stream_generation(*args):
+    # used for streaming the answer directly
+    request_start = time.perf_counter()
+    return GenerationResult(join_write_stream(raw_stream_generation(*args), request_start), None, None)
+
+
 def chat_page():
     st.title(f"{LLM_BACKUP_EMOJI} Chat with the Lab's LLM")
     st.markdown("Welcome to the chat interface!  \n"
@@ -245,14 +350,11 @@ def chat_page():
     formatted_codes, _ = get_coding_task_formatted_codes()
 
     # Initialize chat history if it doesn't exist
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = [
-            {"role": "system", "content": get_system_prompt(CHAT_TASK)}]
+    if "chat_context" not in st.session_state:
+        st.session_state.chat_context = get_session_coder().new_chat()
 
     # Display chat history
-    for message in st.session_state.chat_history:
-        if message["role"] == "system":
-            continue
+    for message in st.session_state.chat_context.messages:
         with st.chat_message(message["role"]):
             # st.markdown(message["content"].replace("_", "\\_"))
             st.markdown(format_coded_result(message["content"], formatted_codes))
@@ -261,19 +363,18 @@ def chat_page():
     if prompt := st.chat_input("Your message:"):
         with st.chat_message("user"):
             st.markdown(format_coded_result(prompt, formatted_codes))
-        st.session_state.chat_history.append({"role": "user", "content": prompt})
         with st.chat_message("assistant"):
             # st.write_stream(response := list(f"ECHO: {prompt}"))
             # response = "".join(response)  # TODO remove!
             try:
-                response, log = generate_for_chat_with_write_stream(st.session_state.chat_history)
+                get_session_coder().chat_turn(st.session_state.chat_context, prompt,
+                                              generation_func=write_stream_generation)
             except Exception as e:
                 st.warning("Connection to the model has crashed...\n"
                            "You should refresh the page, "
                            "but maybe **first save a copy of the conversation so far**")
                 st.error(e)
-        st.session_state.chat_history.append({"role": "assistant", "content": response})
-        save_generation_log(single_generation_log=log)
+                st.stop()  # keeps the error on the page, the message is sent again with the next one
         st.rerun()  # to format the codes in the text
 
     page_bottom()
@@ -294,6 +395,16 @@ def debug_page():
     EXAMPLE_OUTPUT_BY_FREE_MODEL = """Last summer, Mommy and Daddy took me and my little brother to the zoo. _high_ It was super hot, and I got sticky from my ice cream, but I didn’t care. _high_ We saw a giraffe eat leaves from a tall tree—its tongue was purple! _high_ I laughed so hard when the monkey made faces at us. _high_ Then we rode the zoo train. _high_ It went choo-choo and I waved at the people like I was the driver. _high_ Before we left, Daddy let me pick a toy from the gift shop, and I got a tiny lion with fluffy fur. _high_ I named him Roary and he sleeps in my bed every night now. _high_"""
     st.markdown(format_coded_result(EXAMPLE_OUTPUT_BY_FREE_MODEL, formatted_codes))
 
+    st.caption("Response cache statistics:")
+    st.write(get_response_cache().get_stats())
+    st.caption("Model services request scheduling statistics:")
+    st.write(get_all_schedulers_stats())
+    st.caption("Model routes health and hedging statistics:")
+    st.write(get_router().get_stats())
+    performance_panel()
+    if st.button("Reload private examples (index the new ones)"):
+        st.write(reload_private_examples())
+
     conn = get_gsheets_connection()
     st.code(dir(conn))
     old_df = conn.read(ttl=0)
@@ -311,6 +422,26 @@ def debug_page():
     page_bottom()
 
 
+def performance_panel():
+    st.subheader("Performance")
+    st.caption(f"Timing of every stage of the recent generations, in milliseconds (of the last "
+               f"{SPAN_STATS_WINDOW} of each stage). The spans of every generation are also in its log.")
+    span_stats = get_span_stats()
+    if span_stats:
+        st.dataframe([{"stage": stage, **stats} for stage, stats in span_stats.items()], hide_index=True)
+    else:
+        st.info("Nothing was timed yet")
+    trace_path = get_trace_path()
+    if st.checkbox(f"Export every span to a local trace file ({TRACE_FILE_PATH})", value=trace_path is not None):
+        if trace_path is None:
+            set_trace_path(TRACE_FILE_PATH)
+    elif trace_path is not None:
+        set_trace_path(None)
+    if st.button("Reset the timing statistics"):
+        reset_span_stats()
+        st.rerun()
+
+
 def highlight_page():
     st.title(f"{PALETTE_EMOJI} Highlight Codes in text")
     model_config = validate_model_config()
@@ -0,0 +1,21 @@
+from prompting import code_text
+from segmented_coding import code_segmented_memory, is_long_memory
+from coherence_scoring import score_memory
+from constants import *
+
+
+def code_memory(memory, message_history=None, use_cache=True, generation_func=None, *, model_parameters, **kwargs):
+    """
+    Codes a single memory with the coding task's engine: NaCCS memories are only scored
+    (see coherence_scoring.py), and long SLV memories are coded in windows (see segmented_coding.py),
+    which aren't streamed with generation_func
+    :return: the coded result, the messages and the generation log
+    """
+    coding_task = model_parameters[3]
+    if coding_task == NARRATIVE_COHERENCE:
+        return score_memory(memory, message_history, use_cache, generation_func, model_parameters=model_parameters,
+                            **kwargs)
+    if message_history is not None and is_long_memory(memory, coding_task):
+        return code_segmented_memory(memory, message_history, use_cache, model_parameters=model_parameters, **kwargs)
+    return code_text(memory, message_history, use_cache, generation_func, model_parameters=model_parameters,
+                     **kwargs)
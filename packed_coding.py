@@ -0,0 +1,97 @@
+import re
+import json
+
+from prompting import generate_with_retries, raw_generation, get_generation_kwargs, \
+    get_generation_log, get_coding_messages
+from response_cache import get_response_cache, should_use_cache
+from routing import Route
+from token_budget import get_token_budget_policy
+from coded_results import is_valid_coded_result
+from segmented_coding import is_long_memory
+from memory_coding import code_memory
+from constants import *
+
+PACKED_RESULT_PATTERN = re.compile(r"^### RESULT (\d+)[ \t]*\n(.*?)\n### END \1[ \t]*$", re.MULTILINE | re.DOTALL)
+
+
+def get_packed_messages(message_history, memories, coding_task):
+    # the private examples are those most similar to all the memories together
+    system_prompt = f"{message_history[0]['content']}\n\n{PACKED_INPUT_INSTRUCTION}"
+    packed_input = "\n".join(f"### MEMORY {i}\n{memory}\n### END {i}" for i, memory in enumerate(memories, start=1))
+    return get_coding_messages([{"role": "system", "content": system_prompt}] + message_history[1:], packed_input,
+                               coding_task)
+
+
+def split_packed_output(output, num_memories):
+    """
+    :return: the result of each memory in the packed output, None for those missing from it
+    """
+    results = [None] * num_memories
+    for match in PACKED_RESULT_PATTERN.finditer(output):
+        i = int(match.group(1)) - 1
+        if 0 <= i < num_memories and results[i] is None:
+            results[i] = match.group(2).strip()
+    return results
+
+
+def code_packed_memories(items, message_history, model_parameters, user, use_cache=True, warning_callback=None,
+                         backup_routes=(), **kwargs):
+    """
+    Codes several memories in a single request, and falls back to coding alone (with code_memory)
+    every memory whose result is missing from the packed output or is invalid,
+    and every long memory (see segmented_coding.py)
+    :param items: list of (key, memory)
+    :return: list of (key, memory, result, generation_log, error), in the same order as items,
+             and the generation logs of the packed requests themselves (for the caller to save)
+    """
+    client, service, base_llm, coding_task = model_parameters
+    route = Route(client, service, base_llm)
+    generation_kwargs = get_generation_kwargs(**kwargs)
+    look_in_cache = use_cache and should_use_cache(generation_kwargs)
+    coded, to_pack, pack_logs = {}, [], []
+    for key, memory in items:
+        single_messages = get_coding_messages(message_history, memory, coding_task)
+        cache_key = get_response_cache().get_key(route, single_messages, generation_kwargs) if look_in_cache else None
+        result = get_response_cache().get(cache_key) if look_in_cache else None
+        if result:
+            coded[key] = (result, get_generation_log(service, base_llm, coding_task, single_messages,
+                                                     generation_kwargs, result, user=user))
+        elif not is_long_memory(memory, coding_task):
+            to_pack.append((key, memory, single_messages, cache_key))
+
+    if len(to_pack) > 1:
+        packed_kwargs = dict(kwargs)
+        if MAX_TOKENS_PARAM not in packed_kwargs:  # the learned budget is for a single memory
+            single_max_tokens = get_token_budget_policy().get_initial_max_tokens(base_llm, coding_task)
+            packed_kwargs[MAX_TOKENS_PARAM] = min(single_max_tokens * len(to_pack), TOKEN_BUDGET_MAX_MAX_TOKENS)
+        packed_messages = get_packed_messages(message_history, [m for _, m, _, _ in to_pack], coding_task)
+        output, pack_log = generate_with_retries(packed_messages, raw_generation, PACKED_CODING_TASK, model_parameters, user,
+                                                 warning_callback=warning_callback, backup_routes=backup_routes,
+                                                 **packed_kwargs)
+        pack_logs.append(pack_log)
+        served_route = json.loads(pack_log[ROUTE_COLUMN])
+        served_by_route = served_route[SERVICE_COLUMN] == service and served_route[BASE_LLM_COLUMN] == base_llm
+        for (key, memory, single_messages, cache_key), result in zip(to_pack, split_packed_output(output, len(to_pack))):
+            if is_valid_coded_result(memory, result, coding_task):
+                # logged as if it was coded alone, with the packed request's generation kwargs
+                log = get_generation_log(service, base_llm, coding_task, single_messages,
+                                         pack_log[GEN_KWARGS_COLUMN], result, user=user)
+                log[ROUTE_COLUMN] = pack_log[ROUTE_COLUMN]
+                coded[key] = (result, log)
+                if cache_key is not None and served_by_route:
+                    get_response_cache().put(cache_key, result)
+
+    packed_results = []
+    for key, memory in items:
+        if key in coded:
+            packed_results.append((key, memory, *coded[key], None))
+            continue
+        try:  # fallback to a single memory request
+            result, _, log = code_memory(memory, message_history, use_cache=use_cache,
+                                         model_parameters=model_parameters, user=user,
+                                         warning_callback=warning_callback, backup_routes=backup_routes, **kwargs)
+        except Exception as e:
+            packed_results.append((key, memory, None, None, e))
+        else:
+            packed_results.append((key, memory, result, log, None))
+    return packed_results, pack_logs
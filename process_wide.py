@@ -0,0 +1,41 @@
+import threading
+from functools import wraps
+
+
+def process_wide(factory=None, *, key=None):
+    """
+    Makes factory(*args) return the same instance for the whole process (shared by all the sessions and
+    their threads), created on its first call: one instance per key(*args), by default per args.
+    The decorated function also has get(key), get_instances() and replace(key, instance), which returns
+    the instance it replaced (e.g. to close it), or None
+    """
+    if factory is None:  # @process_wide(key=...)
+        return lambda factory: process_wide(factory, key=key)
+    get_key = key or (lambda *args: args)
+    instances = {}
+    lock = threading.Lock()
+
+    @wraps(factory)
+    def get_instance(*args):
+        instance_key = get_key(*args)
+        with lock:
+            if instance_key not in instances:
+                instances[instance_key] = factory(*args)
+            return instances[instance_key]
+
+    def get(instance_key):
+        with lock:
+            return instances.get(instance_key)
+
+    def get_instances():
+        with lock:
+            return dict(instances)
+
+    def replace(instance_key, instance):
+        with lock:
+            previous_instance = instances.get(instance_key)
+            instances[instance_key] = instance
+        return previous_instance
+
+    get_instance.get, get_instance.get_instances, get_instance.replace = get, get_instances, replace
+    return get_instance
@@ -1,11 +1,25 @@
 # TODO: rename to prompting.py
+import json
 import time
-import pandas as pd
-from together import Together
-from openai import OpenAI
-from huggingface_hub import InferenceClient
+import logging
+from functools import lru_cache
+from collections import namedtuple
+from generation_logging import get_generation_log_sink
+from response_cache import get_response_cache, should_use_cache
+from token_budget import get_token_budget_policy
+from routing import Route, get_router
+from instrumentation import span, set_span_attributes, collect_spans
+from example_index import ExampleIndex
+from coded_results import is_valid_coded_result
+from process_wide import process_wide
 from constants import *
 
+logger = logging.getLogger(__name__)
+
+# what every generation function returns (finish_reason and the tokens are None if unknown)
+GenerationResult = namedtuple("GenerationResult", ["output", "finish_reason", "completion_tokens", "prompt_tokens"],
+                              defaults=[None])
+
 
 def parse_example_for_system_prompt(example, output_prefix=""):
     if type(example) is str:
@@ -23,48 +37,142 @@ def parse_example_for_system_prompt(example, output_prefix=""):
 
 
 def get_private_examples(sheet):
+    """
+    The app's examples loader: it reads with the session's G-Sheets connection,
+    so it is called only from the app's thread (see load_example_indices)
+    :param sheet: the worksheet (inside the shared G-Sheet) with INPUT, OUTPUT and EXPLANATION columns
+    """
     if not sheet:
         return []
-    return []  # TODO: needs implementation!
+    rows = get_gsheets_connection().read(worksheet=sheet, ttl=0).fillna("")
+    return [{column: str(row[column]).strip() for column in (INPUT, OUTPUT, EXPLANATION)
+             if str(row.get(column, "")).strip()}
+            for row in rows.to_dict("records")]
 
 
-def get_system_prompt(prompt_type_task=DIRECT_CODING_TASK):
-    coding_task = validate_model_config()[CODING_TASK]
+@process_wide(key=lambda coding_task, examples_loader: coding_task)
+def load_example_indices(coding_task, examples_loader):
+    """
+    Loads the indices of the coding task's private examples (correct ones, incorrect ones), unless they are
+    already loaded. It is called from the calling thread (see coder.Coder), never from the batch workers,
+    which only search them.
+    :param examples_loader: examples_loader(sheet) returns the sheet's examples (e.g. get_private_examples)
+    """
+    parameters = PARAMETERS_BY_CODING_TASK[coding_task]
+    indices = (ExampleIndex(), ExampleIndex())
+    for index, sheet in zip(indices, (parameters[PRIVATE_CORRECT_EXAMPLES_SHEET],
+                                      parameters[PRIVATE_INCORRECT_EXAMPLES_SHEET])):
+        if sheet:
+            index.sync(examples_loader(sheet))
+    return indices
+
+
+def get_example_indices(coding_task):
+    """
+    :return: the loaded indices of the coding task's private examples (see load_example_indices), or None
+    """
+    return load_example_indices.get(coding_task)
+
+
+def reload_private_examples(examples_loader=get_private_examples):
+    """
+    Should be called whenever the private examples sheets change, only new examples are indexed
+    (the indices of tasks that weren't used yet are loaded on their first use anyway)
+    :return: {coding_task: number of new examples}
+    """
+    loaded_indices = load_example_indices.get_instances()
+    num_new_examples = {}
+    for coding_task, indices in loaded_indices.items():
+        parameters = PARAMETERS_BY_CODING_TASK[coding_task]
+        num_new_examples[coding_task] = sum(
+            index.sync(examples_loader(sheet) if sheet else [])
+            for index, sheet in zip(indices, (parameters[PRIVATE_CORRECT_EXAMPLES_SHEET],
+                                              parameters[PRIVATE_INCORRECT_EXAMPLES_SHEET])))
+    return num_new_examples
+
+
+def select_examples(index: ExampleIndex, text, k, max_tokens, output_prefix):
+    """
+    :return: the parsed examples (see parse_example_for_system_prompt) of up to k of the examples
+             most similar to the text, that fit in max_tokens, and the tokens they take
+    """
+    selected, num_tokens = [], 0
+    for example in index.search(text, k * EXAMPLE_INDEX_CANDIDATES_FACTOR):
+        parsed_example = parse_example_for_system_prompt(example, output_prefix)
+        example_tokens = len(parsed_example) // ESTIMATED_CHARS_PER_TOKEN
+        if num_tokens + example_tokens > max_tokens:
+            continue  # a shorter example might still fit
+        selected.append(parsed_example)
+        num_tokens += example_tokens
+        if len(selected) == k:
+            break
+    return selected, num_tokens
+
+
+def get_examples_message(text, coding_task):
+    """
+    :param text: the memory to code (or all the memories of a packed request)
+    :return: a system message with the private examples most similar to the text
+             (correct ones first, within FEW_SHOT_MAX_TOKENS), or None if there are none
+             (or they weren't loaded, see load_example_indices)
+    """
+    indices = get_example_indices(coding_task)
+    if indices is None:
+        return None
+    correct_index, incorrect_index = indices
+    if not len(correct_index) and not len(incorrect_index):
+        return None
+    correct_examples, num_tokens = select_examples(correct_index, text, FEW_SHOT_CORRECT_K,
+                                                   FEW_SHOT_MAX_TOKENS, "CORRECT")
+    incorrect_examples, _ = select_examples(incorrect_index, text, FEW_SHOT_INCORRECT_K,
+                                            FEW_SHOT_MAX_TOKENS - num_tokens, "INCORRECT")
+    message_parts = []
+    for examples, title in [(correct_examples, "EXAMPLES FOR CORRECT CODINGS"),
+                            (incorrect_examples, "EXAMPLES FOR INCORRECT CODINGS")]:
+        if examples:
+            message_parts.append(f"\n\n{title}:")
+            message_parts.extend(examples)
+    if not message_parts:
+        return None
+    return {"role": "system", "content": f"{FEW_SHOT_TITLE}{''.join(message_parts)}"}
+
+
+def get_coding_messages(message_history, memory, coding_task):
+    """
+    The message history, the private examples most similar to the memory (if any) and the memory
+    """
+    with span(FEW_SHOT_SPAN):
+        examples_message = get_examples_message(memory, coding_task)
+    return message_history + ([examples_message] if examples_message else []) + \
+        [{"role": "user", "content": memory}]
+
+
+def get_system_prompt(prompt_type_task, coding_task):
+    with span(SYSTEM_PROMPT_SPAN, coding_task=coding_task, prompt_type_task=prompt_type_task):
+        return compile_system_prompt(coding_task, prompt_type_task)
+
+
+@lru_cache(maxsize=None)  # process-wide, so it is shared by all sessions
+def compile_system_prompt(coding_task, prompt_type_task):
+    # only the public examples are in the system prompt, the private ones are selected for every memory
+    # (see get_coding_messages), so the prompt doesn't grow with them
     parameters = PARAMETERS_BY_CODING_TASK[coding_task]
     task_instruction = parameters[TASK_DEFINITION]
     input_format, output_format = parameters[INPUT_FORMAT_INSTRUCTION], parameters[OUTPUT_FORMAT_INSTRUCTION]
-    system_prompt = f"{SYSTEM_INTRO}\n\nCODING SCHEME:\n{task_instruction}"
+    system_prompt_parts = [f"{SYSTEM_INTRO}\n\nCODING SCHEME:\n{task_instruction}"]
     if prompt_type_task == CHAT_TASK:
-        system_prompt += f"\n\n{CHAT_INSTRUCTION_FORMAT.format(input_format, output_format)}"
+        system_prompt_parts.append(f"\n\n{CHAT_INSTRUCTION_FORMAT.format(input_format, output_format)}")
     else:  # prompt_type_task == DIRECT_CODING_TASK
-        system_prompt += f"\n\nINPUT FORMAT:\n{input_format}\n\nOUTPUT FORMAT:\n{output_format}"
-        system_prompt += f"\n{STRICT_OUTPUT_FORMAT_REMINDER}"
+        system_prompt_parts.append(f"\n\nINPUT FORMAT:\n{input_format}\n\nOUTPUT FORMAT:\n{output_format}")
+        system_prompt_parts.append(f"\n{STRICT_OUTPUT_FORMAT_REMINDER}")
     public_correct_examples, public_incorrect_examples = parameters[PUBLIC_CORRECT_EXAMPLES], parameters[PUBLIC_INCORRECT_EXAMPLES]
-    private_correct_examples = get_private_examples(parameters[PRIVATE_CORRECT_EXAMPLES_SHEET])
-    private_incorrect_examples = get_private_examples(parameters[PRIVATE_INCORRECT_EXAMPLES_SHEET])
-    for examples, title, output_prefix in [(public_correct_examples + private_correct_examples, "EXAMPLES FOR CORRECT CODINGS", "CORRECT"),
-                                           (public_incorrect_examples + private_incorrect_examples, "EXAMPLES FOR INCORRECT CODINGS", "INCORRECT")]:
+    for examples, title, output_prefix in [(public_correct_examples, "EXAMPLES FOR CORRECT CODINGS", "CORRECT"),
+                                           (public_incorrect_examples, "EXAMPLES FOR INCORRECT CODINGS", "INCORRECT")]:
         if examples:
-            system_prompt += f"\n\n{title}:"
-            for example in examples:
-                system_prompt += parse_example_for_system_prompt(example, output_prefix)
-    return system_prompt
-
-
-def get_model_config_parameters():
-    model_config = validate_model_config()
-    service = model_config[MODEL_SERVICE]
-    if service not in st.session_state:
-        if service == PRIVATE_SERVICE:
-            client = InferenceClient(provider="hf-inference", api_key=st.secrets["HF_API_KEY"])
-        else:  # service == FREE_SERVICE
-            # client = Together(api_key=st.secrets["TOGETHER_API_KEY"])
-            client = OpenAI(base_url="https://router.huggingface.co/v1", api_key=st.secrets["HF_API_KEY"])
-        st.session_state[service] = client
-    client = st.session_state[service]
-    base_llm = model_config[BASE_LLM]
-    coding_task = model_config[CODING_TASK]
-    return client, service, base_llm, coding_task
+            system_prompt_parts.append(f"\n\n{title}:")
+            system_prompt_parts.extend(parse_example_for_system_prompt(example, output_prefix)
+                                       for example in examples)
+    return "".join(system_prompt_parts)
 
 
 def get_generation_kwargs(**kwargs):
@@ -76,70 +184,138 @@ def get_generation_kwargs(**kwargs):
 
 
 def get_generation_log(service, base_llm, coding_task, messages,
-                       generation_kwargs, output, task=DIRECT_CODING_TASK):
+                       generation_kwargs, output, task=DIRECT_CODING_TASK, user=None, spans=None, usage=None,
+                       route=None):
     return {
         TIMESTAMP_COLUMN: time.strftime("%x %X"),
-        USERNAME_COLUMN: st.session_state.get("user", "error"),
+        USERNAME_COLUMN: user,
         SERVICE_COLUMN: service,
         BASE_LLM_COLUMN: base_llm,
         CODING_TASK_COLUMN: coding_task,
         INPUT_COLUMN: str(messages),
         GEN_KWARGS_COLUMN: str(generation_kwargs),
         OUTPUT_COLUMN: output,
-        TASK_COLUMN: task
+        TASK_COLUMN: task,
+        SPANS_COLUMN: json.dumps(spans) if spans is not None else None,
+        USAGE_COLUMN: json.dumps(usage) if usage is not None else None,
+        CONVERSATION_ID_COLUMN: None,
+        ROUTE_COLUMN: json.dumps(route) if route is not None else None
     }
 
 
 def save_generation_log(single_generation_log: dict[str, str] = None,
-                        multiple_generation_logs: list[dict[str]] = None):
-    conn = get_gsheets_connection()
-    df = conn.read(ttl=0)
+                        multiple_generation_logs: list[dict[str]] = None, log_sink=None):
+    # only queues the logs (in the process-wide sink by default),
+    # they are appended to the log sink in bulk by a background thread.
+    # A log that can't be saved is only reported, so the result it is of is never lost because of it
+    logs = []
     if single_generation_log:
-        df.loc[len(df)] = single_generation_log
+        logs.append(single_generation_log)
     if multiple_generation_logs:
-        df = pd.concat([df, pd.DataFrame(multiple_generation_logs)], ignore_index=True)
-    conn.update(data=df)
+        logs.extend(multiple_generation_logs)
+    if logs:
+        with span(SAVE_GENERATION_LOG_SPAN, num_logs=len(logs)):
+            try:
+                (log_sink or get_generation_log_sink()).append(logs)
+            except Exception:
+                logger.exception(f"Failed to save {len(logs)} generation logs")
 
 
-def code_text(new_message: str, message_history: list[dict[str, str]] = None, **kwargs):
+def code_text(new_message: str, message_history: list[dict[str, str]] = None, use_cache=True,
+              generation_func=None, *, model_parameters, output_validator=None, **kwargs):
+    """
+    :param output_validator: see generate_with_retries, a valid coded result of new_message by default
+    """
+    coding_task = model_parameters[3]
     if message_history is None:
-        messages = [{"role": "system", "content": get_system_prompt()}]
-    else:
-        messages = message_history.copy()
-    messages.append({"role": "user", "content": new_message})
-    output, log = generate_with_retries(messages, raw_generation, **kwargs)
+        message_history = [{"role": "system", "content": get_system_prompt(DIRECT_CODING_TASK, coding_task)}]
+    messages = get_coding_messages(message_history, new_message, coding_task)
+    if output_validator is None:
+        output_validator = lambda output: is_valid_coded_result(new_message, output, coding_task)
+    output, log = generate_with_retries(messages, generation_func or raw_generation, DIRECT_CODING_TASK,
+                                        model_parameters, use_cache=use_cache, output_validator=output_validator,
+                                        **kwargs)
     # messages.append({"role": "assistant", "content": output})
     return output, messages, log
 
 
-def generate_with_retries(messages, generation_func, task=DIRECT_CODING_TASK, **kwargs):
-    client, service, base_llm, coding_task = get_model_config_parameters()
+def generate_with_retries(messages, generation_func, task, model_parameters, user=None, use_cache=False,
+                          warning_callback=None, backup_routes=(), output_validator=None, **kwargs):
+    """
+    :param warning_callback: called with a message when the generation is re-tried, or fails
+    :param backup_routes: routes (see routing.Route) to fail over to when the model service is unhealthy,
+                          and to hedge its slow requests with
+    :param output_validator: output_validator(output) is False for outputs that must not be cached (e.g. malformed)
+    """
+    client, service, base_llm, coding_task = model_parameters
+    routes = [Route(client, service, base_llm), *backup_routes]
+    # streaming generations write to the page while they are generated, so they are never run twice at once
+    hedge = generation_func is raw_generation
     generation_kwargs = get_generation_kwargs(**kwargs)
-    allowed_tries = MAX_ALLOWED_RETRIES
-    output = ""
-    while allowed_tries > 0:
-        if allowed_tries < MAX_ALLOWED_RETRIES:
-            st.warning(f"Failed to generate with {generation_kwargs[MAX_TOKENS_PARAM]} max tokens,"
-                       f"probably due to the model's thinking tokens. Re-trying with more...")
-            generation_kwargs[MAX_TOKENS_PARAM] += MAX_TOKENS_INC_STEP
-        output = generation_func(client, base_llm, messages, generation_kwargs)
+    cache_key = None
+    if use_cache and should_use_cache(generation_kwargs):
+        cache_key = get_response_cache().get_key(routes[0], messages, generation_kwargs)
+        output = get_response_cache().get(cache_key)
         if output:
-            break
-        allowed_tries -= 1
+            log = get_generation_log(service, base_llm, coding_task, messages, generation_kwargs,
+                                     output, task, user)
+            return output, log
+    token_budget = get_token_budget_policy()
+    if MAX_TOKENS_PARAM not in kwargs:
+        generation_kwargs[MAX_TOKENS_PARAM] = token_budget.get_initial_max_tokens(base_llm, coding_task)
+    output, truncated_output, route = "", "", None
+    usage = {PROMPT_TOKENS: 0, COMPLETION_TOKENS: 0}
+    with collect_spans() as spans:
+        for try_number in range(MAX_ALLOWED_RETRIES):
+            if try_number > 0:
+                if warning_callback is not None:
+                    warning_callback(f"Failed to generate with {generation_kwargs[MAX_TOKENS_PARAM]} max tokens,"
+                                     f"probably due to the model's thinking tokens. Re-trying with more...")
+                generation_kwargs[MAX_TOKENS_PARAM] = token_budget.grow(generation_kwargs[MAX_TOKENS_PARAM])
+            generation, served_route, reason = get_router().run(routes, generation_func,
+                                                                get_continuation_messages(messages, truncated_output),
+                                                                generation_kwargs, task, hedge)
+            route = {SERVICE_COLUMN: served_route.service, BASE_LLM_COLUMN: served_route.base_llm, "reason": reason}
+            usage[PROMPT_TOKENS] += generation.prompt_tokens or 0
+            usage[COMPLETION_TOKENS] += generation.completion_tokens or 0
+            if generation.finish_reason != FINISH_REASON_LENGTH and generation.output:
+                output = truncated_output + generation.output
+                break
+            if generation.finish_reason == FINISH_REASON_LENGTH and \
+                    served_route.service in CONTINUE_TRUNCATED_OUTPUT_SERVICES:
+                truncated_output += generation.output or ""  # empty if the thinking took all the tokens
     if not output:
-        st.error(f"Failed to generate a response, probably due to the model's thinking tokens."
-                 f"(re-tried {MAX_ALLOWED_RETRIES} times)")
-    log = get_generation_log(service, base_llm, coding_task, messages, generation_kwargs, output, task)
+        if warning_callback is not None:
+            warning_callback(f"Failed to generate a response, probably due to the model's thinking tokens."
+                             f"(re-tried {MAX_ALLOWED_RETRIES} times)")
+    elif route[BASE_LLM_COLUMN] == base_llm:  # the budget and cache are only of the configured model
+        if task == DIRECT_CODING_TASK:  # the budget is learned for coding a single memory
+            token_budget.record(base_llm, coding_task, usage[COMPLETION_TOKENS])
+        if cache_key is not None and route[SERVICE_COLUMN] == service and \
+                (output_validator is None or output_validator(output)):
+            get_response_cache().put(cache_key, output)
+    log = get_generation_log(service, base_llm, coding_task, messages, generation_kwargs, output, task,
+                             user, spans, usage, route)
     return output, log
 
 
+def get_continuation_messages(messages, truncated_output):
+    if not truncated_output:
+        return messages
+    return messages + [{"role": "assistant", "content": truncated_output},
+                       {"role": "user", "content": CONTINUE_TRUNCATED_OUTPUT_INSTRUCTION}]
+
+
 def raw_generation(client, base_llm, messages, generation_kwargs):
     response = client.chat.completions.create(model=base_llm, messages=messages,
                                               **generation_kwargs)
     choice = response.choices[0]
-    if getattr(choice, "finish_reason", None) == "length":
-        return ""
-    return choice.message.content
+    usage = getattr(response, "usage", None)
+    generation = GenerationResult(choice.message.content, getattr(choice, "finish_reason", None),
+                                  getattr(usage, COMPLETION_TOKENS, None), getattr(usage, PROMPT_TOKENS, None))
+    set_span_attributes(finish_reason=generation.finish_reason, completion_tokens=generation.completion_tokens,
+                        prompt_tokens=generation.prompt_tokens)
+    return generation
 
 
 def raw_stream_generation(client, base_llm, messages, generation_kwargs):
@@ -147,36 +323,29 @@ def raw_stream_generation(client, base_llm, messages, generation_kwargs):
                                           stream=True, **generation_kwargs)
 
 
-def join_write_stream(stream):
-    content_parts = []
-    def generator():
-        for chunk in stream:
+def get_streaming_generation_func(on_text, render_interval=STREAM_RENDER_INTERVAL_SECONDS):
+    """
+    A generation function that streams the output and calls on_text(output_so_far) while it is generated
+    (at most once every render_interval seconds, and once at the end)
+    """
+    def streaming_generation(client, base_llm, messages, generation_kwargs):
+        output, finish_reason, last_render = "", None, 0
+        request_start = time.perf_counter()
+        for chunk in raw_stream_generation(client, base_llm, messages, generation_kwargs):
             try:
-                content = chunk.choices[0].delta.content  # TODO: consider using chunk.choices[0].finish_reason == "length"
-                if content:
-                    content_parts.append(content)
-                    yield content
-            except (AttributeError, IndexError, KeyError):
-                # Skip malformed chunks
-                continue
-    st.write_stream(generator())
-    return "".join(content_parts)
-
-
-def generate_for_chat_with_write_stream(messages: list[dict[str, str]], **kwargs):
-    # used for streaming the answer directly
-    generation_func = lambda *args: join_write_stream(raw_stream_generation(*args))
-    output, log = generate_with_retries(messages, generation_func, CHAT_TASK, **kwargs)
-    # appending the message to all messages should be outside of assistant scope
-    return output, log
-
-
-
-def generate_for_chat(messages: list[dict[str, str]], temperature: float = 0):
-    # original deprecated function
-    client, service, base_llm, coding_task = get_model_config_parameters()
-    generation_kwargs = dict(temperature=temperature)
-    output = raw_generation(client, base_llm, messages, generation_kwargs)
-    log = get_generation_log(service, base_llm, coding_task, messages, generation_kwargs, output, CHAT_TASK)
-    messages.append({"role": "assistant", "content": output})  # first add to show user
-    save_generation_log(single_generation_log=log)  # then save log
+                choice = chunk.choices[0]
+            except (AttributeError, IndexError):
+                continue  # e.g. a usage-only chunk
+            finish_reason = getattr(choice, "finish_reason", None) or finish_reason
+            content = getattr(choice.delta, "content", None)
+            if content:
+                if not output:
+                    set_span_attributes(**{TIME_TO_FIRST_TOKEN_MS: round((time.perf_counter() - request_start) * 1000, 3)})
+                output += content
+                if time.monotonic() - last_render >= render_interval:
+                    on_text(output)
+                    last_render = time.monotonic()
+        on_text(output)
+        set_span_attributes(finish_reason=finish_reason)
+        return GenerationResult(output, finish_reason, None)
+    return streaming_generation
@@ -0,0 +1,93 @@
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from process_wide import process_wide
+from constants import *
+
+
+class ResponseCache:
+    """
+    Persistent cache of model outputs, keyed by a hash of everything that determines the output
+    (the route's service, endpoint and model, messages including the system prompt, and generation kwargs).
+    Stored in SQLite, and evicted by least-recent use when the stored outputs exceed `max_size_bytes`.
+    """
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_size_bytes=RESPONSE_CACHE_MAX_SIZE_BYTES):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                                "output TEXT, size INTEGER, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_by_access "
+                                "ON responses (last_access)")
+        self.connection.commit()
+        self.size_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def get_key(route, messages, generation_kwargs):
+        """
+        :param route: routing.Route of the request (the same model may be served differently by each endpoint)
+        """
+        base_url = getattr(route.client, "base_url", None)
+        content = json.dumps([route.service, base_url and str(base_url), route.base_llm, messages, generation_kwargs],
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT output FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?",
+                                        (time.time(), key))
+            return row[0]
+
+    def put(self, key, output):
+        size = len(output.encode("utf-8"))
+        with self.lock, self.connection:
+            old_row = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old_row is not None:
+                self.size_bytes -= old_row[0]
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                    (key, output, size, time.time()))
+            self.size_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self.size_bytes > self.max_size_bytes:
+            rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access "
+                                           "LIMIT ?", (RESPONSE_CACHE_EVICTION_BATCH,)).fetchall()
+            if not rows:
+                self.size_bytes = 0
+                return
+            for key, size in rows:
+                if self.size_bytes <= self.max_size_bytes:
+                    return
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size_bytes -= size
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses")
+            self.size_bytes = 0
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size_bytes": self.size_bytes,
+                "max_size_bytes": self.max_size_bytes}
+
+
+def should_use_cache(generation_kwargs):
+    # sampling with temperature > 0 is expected to give a different output each time
+    return RESPONSE_CACHE_ENABLED and generation_kwargs.get(TEMPERATURE_PARAM, DEFAULT_TEMPERATURE) <= 0
+
+
+@process_wide
+def get_response_cache():
+    return ResponseCache()
@@ -0,0 +1,217 @@
+import time
+import threading
+from collections import namedtuple, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from scheduling import get_scheduler, is_input_error, RequestCancelledError
+from instrumentation import span, set_span_attributes, collect_spans, add_collected_spans
+from process_wide import process_wide
+from constants import *
+
+# a model of a model service, and the client to send it requests
+Route = namedtuple("Route", ["client", "service", "base_llm"])
+
+
+class RoutedRequest:
+    """
+    The state of a request to a route, shared with the thread that decides whether to hedge it
+    """
+    def __init__(self):
+        self.sent = threading.Event()  # set once the scheduler sends it (or once it ends without being sent)
+        self.cancelled = threading.Event()  # set to drop it while it still waits for its turn in the scheduler
+        self.attempt_start = None  # of its last attempt, after it waited for the rate limits
+
+
+class RouteStats:
+    """
+    The recent latencies (of every task, e.g. coding a single memory or a packed request) and errors of a route
+    """
+    def __init__(self):
+        self.latencies = defaultdict(lambda: deque(maxlen=ROUTE_LATENCY_WINDOW))
+        self.outcomes = deque(maxlen=ROUTE_HEALTH_WINDOW)  # True for every failed request
+        self.last_failure = 0
+        self.counts = {"requests": 0, "failed": 0, "hedged": 0, "hedges_won": 0, "failovers": 0}
+        self.lock = threading.Lock()
+
+    def record(self, task, latency_seconds=None, failed=False):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.outcomes.append(failed)
+            if failed:
+                self.counts["failed"] += 1
+                self.last_failure = time.monotonic()
+            else:
+                self.latencies[task].append(latency_seconds)
+
+    def increment(self, count):
+        with self.lock:
+            self.counts[count] += 1
+
+    def get_hedge_deadline(self, task):
+        """
+        :return: the ROUTE_HEDGE_PERCENTILE of the task's recent latencies in seconds,
+                 or None while there are too few of them to tell
+        """
+        with self.lock:
+            latencies = sorted(self.latencies[task])
+        if len(latencies) < ROUTE_MIN_LATENCY_SAMPLES:
+            return None
+        return max(latencies[min(len(latencies) - 1, int(len(latencies) * ROUTE_HEDGE_PERCENTILE))],
+                   ROUTE_MIN_HEDGE_DEADLINE_SECONDS)
+
+    def get_error_rate(self):
+        with self.lock:
+            return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0
+
+    def is_healthy(self):
+        # an unhealthy route is tried again after a cooldown, so it is healthy again once it recovers
+        with self.lock:
+            if len(self.outcomes) < ROUTE_MIN_HEALTH_SAMPLES:
+                return True
+            error_rate = sum(self.outcomes) / len(self.outcomes)
+            recently_failed = time.monotonic() - self.last_failure < ROUTE_UNHEALTHY_COOLDOWN_SECONDS
+        return error_rate < ROUTE_UNHEALTHY_ERROR_RATE or not recently_failed
+
+    def get_stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return {**counts, "error_rate": round(self.get_error_rate(), 3), "healthy": self.is_healthy()}
+
+
+class Router:
+    """
+    Sends every generation to the first healthy route (the primary one, unless it keeps failing), and fails over
+    to the next routes when it fails. When a request to a route takes longer than the route's recent
+    ROUTE_HEDGE_PERCENTILE latency, a duplicate (hedged) request is sent to the next route, and the first answer wins.
+    """
+    def __init__(self, max_threads=ROUTER_MAX_THREADS):
+        self.route_stats = defaultdict(RouteStats)  # by (service, base_llm)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="hedged_generation")
+
+    def get_route_stats(self, route: Route):
+        with self.lock:
+            return self.route_stats[(route.service, route.base_llm)]
+
+    def _generate(self, route: Route, generation_func, messages, generation_kwargs, task, request=None):
+        """
+        The route's latency is only of the request itself, without its wait for the rate limits or backoff,
+        and input errors (see scheduling.is_input_error) aren't failures of the route
+        """
+        request = request or RoutedRequest()
+
+        def timed_generation_func(*args):
+            request.attempt_start = time.monotonic()
+            request.sent.set()
+            return generation_func(*args)
+
+        try:
+            generation = get_scheduler(route.service).run(timed_generation_func, route.client, route.base_llm,
+                                                          messages, generation_kwargs, request.cancelled)
+        except RequestCancelledError:
+            raise
+        except Exception as e:
+            if not is_input_error(e):
+                self.get_route_stats(route).record(task, failed=True)
+            raise
+        finally:
+            request.sent.set()
+        self.get_route_stats(route).record(task, time.monotonic() - request.attempt_start)
+        return generation
+
+    def _generate_in_thread(self, route, generation_func, messages, generation_kwargs, task, request):
+        # the spans of the executor's thread are returned, to add them to the caller's generation log
+        with collect_spans() as spans:
+            return self._generate(route, generation_func, messages, generation_kwargs, task, request), spans
+
+    @staticmethod
+    def _wait_for_deadline(future, request: RoutedRequest, deadline):
+        """
+        Waits until the request is done, or its last attempt took longer than the deadline since it was sent
+        :return: whether it is done
+        """
+        request.sent.wait()  # set when it is done as well
+        while not future.done():
+            remaining_seconds = deadline - (time.monotonic() - request.attempt_start)
+            if remaining_seconds <= 0:
+                return False
+            wait([future], timeout=remaining_seconds)  # a retry after a failed attempt moves the deadline
+        return True
+
+    def _generate_hedged(self, route, backup_route, deadline, generation_func, messages, generation_kwargs, task,
+                         tried_routes):
+        """
+        :param tried_routes: backup_route is added to it once the hedged request is sent
+        :return: the first generation, and whether the hedged request to backup_route generated it
+        """
+        args = (generation_func, messages, generation_kwargs, task)
+        primary_request = RoutedRequest()
+        primary = self.executor.submit(self._generate_in_thread, route, *args, primary_request)
+        if self._wait_for_deadline(primary, primary_request, deadline):
+            generation, spans = primary.result()
+            add_collected_spans(spans)
+            return generation, False
+        self.get_route_stats(route).increment("hedged")
+        tried_routes.append(backup_route)
+        hedge_request = RoutedRequest()
+        hedge = self.executor.submit(self._generate_in_thread, backup_route, *args, hedge_request)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    generation, spans = future.result()
+                    add_collected_spans(spans)
+                    if future is hedge:
+                        self.get_route_stats(route).increment("hedges_won")
+                    # the other request is left to finish if it was sent (its latency is still recorded),
+                    # but isn't sent (again) if it is waiting in its scheduler
+                    (primary_request if future is hedge else hedge_request).cancelled.set()
+                    return generation, future is hedge
+        raise primary.exception()
+
+    def run(self, routes: list[Route], generation_func, messages, generation_kwargs, task, hedge=True):
+        """
+        Runs generation_func(client, base_llm, messages, generation_kwargs) on the routes (see Router)
+        :param routes: the primary route first, then its backups in order of preference
+        :param hedge: False for generation functions that can't run twice at once, or outside the calling thread
+                      (e.g. those streaming to the page), which only fail over
+        :return: the generation, the route that generated it and why (PRIMARY_ROUTE, HEDGE_ROUTE or FAILOVER_ROUTE)
+        """
+        healthy_routes = [route for route in routes if self.get_route_stats(route).is_healthy()]
+        candidates = healthy_routes or list(routes)  # if none is healthy, the one that recovers first is found
+        tried_routes = []
+        with span(ROUTING_SPAN):
+            for i, route in enumerate(candidates):
+                if route in tried_routes:  # a hedged request was already sent to it, and failed as well
+                    continue
+                if tried_routes:
+                    self.get_route_stats(route).increment("failovers")
+                tried_routes.append(route)
+                backup_route = candidates[i + 1] if i + 1 < len(candidates) else None
+                reason = PRIMARY_ROUTE if route == routes[0] else FAILOVER_ROUTE
+                deadline = self.get_route_stats(route).get_hedge_deadline(task) if hedge else None
+                try:
+                    if backup_route is not None and deadline is not None:
+                        generation, hedged = self._generate_hedged(route, backup_route, deadline, generation_func,
+                                                                   messages, generation_kwargs, task, tried_routes)
+                        if hedged:
+                            route, reason = backup_route, HEDGE_ROUTE
+                    else:
+                        generation = self._generate(route, generation_func, messages, generation_kwargs, task)
+                except Exception as e:
+                    if is_input_error(e) or all(candidate in tried_routes for candidate in candidates):
+                        raise  # the other routes would reject the same input
+                    continue
+                set_span_attributes(service=route.service, base_llm=route.base_llm, reason=reason)
+                return generation, route, reason
+
+    def get_stats(self):
+        with self.lock:
+            route_stats = dict(self.route_stats)
+        return {f"{service}/{base_llm}": stats.get_stats() for (service, base_llm), stats in route_stats.items()}
+
+
+@process_wide  # so all the sessions share the health and latency of the routes
+def get_router():
+    return Router()
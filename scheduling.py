@@ -0,0 +1,175 @@
+import sys
+import time
+import random
+import threading
+from instrumentation import span
+from process_wide import process_wide
+from constants import *
+
+
+class TokenBucket:
+    """
+    Allows `rate_per_minute` units per minute on average, with bursts of up to `capacity` units
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+
+    def acquire(self, amount):
+        amount = min(amount, self.capacity)  # otherwise a huge request would wait forever
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait_seconds = (amount - self.available) / self.rate_per_second
+            time.sleep(wait_seconds)
+
+    def release(self, amount):
+        # gives back units that were acquired but not used (e.g. estimated tokens that weren't generated)
+        with self.lock:
+            self._refill()
+            self.available = min(self.capacity, self.available + amount)
+
+
+def get_error_status_code(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:  # e.g. huggingface_hub's errors only have it on their response
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def get_retry_after_seconds(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_connection_error(error):
+    openai = sys.modules.get("openai")  # if it wasn't imported, no openai client sent the request
+    return openai is not None and isinstance(error, openai.APIConnectionError)
+
+
+def is_retriable_error(error):
+    return is_connection_error(error) or get_error_status_code(error) in RETRIABLE_STATUS_CODES
+
+
+def is_input_error(error):
+    return get_error_status_code(error) in INPUT_ERROR_STATUS_CODES
+
+
+class RequestCancelledError(Exception):
+    """
+    Raised instead of sending a request that was cancelled while it waited for its turn
+    """
+    pass
+
+
+class RequestScheduler:
+    """
+    Sends the requests of a single model service within its requests-per-minute and tokens-per-minute
+    limits, and retries rate-limited or failed requests with jittered exponential backoff
+    (honoring Retry-After, which pauses all the requests to the service, not only the failed one)
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute, max_retries=SCHEDULER_MAX_RETRIES):
+        self.requests_bucket = TokenBucket(requests_per_minute)
+        self.tokens_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failed": 0, "queue_depth": 0,
+                      "in_flight": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def _update_stats(self, **increments):
+        with self.lock:
+            for stat, increment in increments.items():
+                self.stats[stat] += increment
+
+    def _wait_for_turn(self, estimated_tokens):
+        start = time.monotonic()
+        self._update_stats(queue_depth=1)
+        try:
+            with span(SCHEDULER_WAIT_SPAN, estimated_tokens=estimated_tokens):
+                while (pause_seconds := self.paused_until - time.monotonic()) > 0:
+                    time.sleep(pause_seconds)
+                self.requests_bucket.acquire(1)
+                self.tokens_bucket.acquire(estimated_tokens)
+        finally:
+            waited = time.monotonic() - start
+            with self.lock:
+                self.stats["queue_depth"] -= 1
+                self.stats["total_wait_seconds"] += waited
+                self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def _back_off(self, error, retry):
+        retry_after = get_retry_after_seconds(error)
+        if retry_after is not None:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            return
+        delay = min(SCHEDULER_BACKOFF_BASE_SECONDS * 2 ** retry, SCHEDULER_BACKOFF_MAX_SECONDS)
+        with span(BACKOFF_SPAN, retry=retry):
+            time.sleep(random.uniform(0, delay))  # "full jitter", so retries of concurrent requests spread out
+
+    def run(self, generation_func, client, base_llm, messages, generation_kwargs, cancel_event=None):
+        """
+        Runs generation_func(client, base_llm, messages, generation_kwargs) when the limits allow it
+        :param cancel_event: once it is set, the request isn't sent (again), and RequestCancelledError is raised
+        """
+        prompt_tokens = sum(len(str(message["content"])) for message in messages) // ESTIMATED_CHARS_PER_TOKEN
+        estimated_tokens = prompt_tokens + generation_kwargs.get(MAX_TOKENS_PARAM, MAX_TOKENS_DEFAULT)
+        for retry in range(self.max_retries + 1):
+            self._wait_for_turn(estimated_tokens)
+            if cancel_event is not None and cancel_event.is_set():  # its turn goes to the next request
+                self.requests_bucket.release(1)
+                self.tokens_bucket.release(estimated_tokens)
+                raise RequestCancelledError()
+            self._update_stats(requests=1, retries=int(retry > 0), in_flight=1)
+            try:
+                with span(GENERATION_ATTEMPT_SPAN, attempt=retry, max_tokens=generation_kwargs.get(MAX_TOKENS_PARAM)):
+                    generation = generation_func(client, base_llm, messages, generation_kwargs)
+            except Exception as e:
+                if not is_retriable_error(e) or retry == self.max_retries:
+                    self._update_stats(failed=1)
+                    raise
+                self._update_stats(rate_limited=int(get_error_status_code(e) == 429))
+                self._back_off(e, retry)
+            else:
+                if generation.completion_tokens is not None:
+                    unused_tokens = estimated_tokens - prompt_tokens - generation.completion_tokens
+                    self.tokens_bucket.release(max(unused_tokens, 0))
+                return generation
+            finally:
+                self._update_stats(in_flight=-1)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+@process_wide(key=lambda service: service)  # so all the sessions share the service's rate limits
+def get_scheduler(service):
+    limits = SERVICE_RATE_LIMITS.get(service, DEFAULT_RATE_LIMITS)
+    return RequestScheduler(limits[REQUESTS_PER_MINUTE], limits[TOKENS_PER_MINUTE])
+
+
+def set_scheduler(service, scheduler: RequestScheduler):
+    """
+    Replaces the scheduler of the service (e.g. with other limits, for benchmarks)
+    """
+    get_scheduler.replace(service, scheduler)
+
+
+def get_all_schedulers_stats():
+    return {service: scheduler.get_stats() for service, scheduler in get_scheduler.get_instances().items()}
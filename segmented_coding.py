@@ -0,0 +1,175 @@
+"""
+Codes long SLV memories (e.g. interview transcripts) in windows of whole sentences, coded in parallel,
+instead of a single request whose output (the whole memory with codes) would hit max_tokens.
+Every window is coded with the beginning of the memory (its main event) and the sentences right before it
+as context, so the locus stays consistent across windows, and the coded windows are stitched back
+with the exact whitespace that separated them in the memory, so without the codes the result is exactly the memory.
+"""
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from prompting import code_text, get_generation_log
+from coded_results import is_valid_coded_result, SLV_CODE_REGEX, MalformedResultError
+from process_wide import process_wide
+from constants import *
+
+# the end of a sentence, with its closing quotes or brackets, and the whitespace after it
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])([\"')\]]*)(\s+)")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+WORD_PATTERN = re.compile(r"\S+")
+SLV_CODE_ONLY_PATTERN = re.compile(SLV_CODE_REGEX)
+SLV_INSERTED_CODE_PATTERN = re.compile(r"\s*" + SLV_CODE_REGEX)  # a code with the whitespace inserted before it
+
+
+@process_wide  # so the windows of all the long memories coded at once (e.g. by batch workers) share its limit
+def get_window_executor():
+    return ThreadPoolExecutor(max_workers=SEGMENTED_MAX_WORKERS, thread_name_prefix="segmented_window")
+
+
+def is_long_memory(memory, coding_task):
+    return coding_task == SEGMENT_LOCUS_VALENCE and len(memory) > SEGMENTED_MIN_CHARS
+
+
+def split_sentences(memory, max_chars=SEGMENTED_WINDOW_CHARS):
+    """
+    :return: [start, end) spans of the memory's sentences, without the whitespace between them
+             (sentences longer than max_chars, e.g. of unpunctuated transcripts, are split at whitespace)
+    """
+    spans, start = [], 0
+    for match in SENTENCE_END_PATTERN.finditer(memory):
+        spans.append((start, match.end(1)))
+        start = match.end(2)
+    end = len(memory.rstrip())
+    if start < end:
+        spans.append((start, end))
+    sentences = []
+    for start, end in spans:
+        while end - start > max_chars:
+            split = None
+            for match in WHITESPACE_PATTERN.finditer(memory, start + 1, start + max_chars):
+                split = match
+            if split is None:
+                break
+            sentences.append((start, split.start()))
+            start = split.end()
+        sentences.append((start, end))
+    return sentences
+
+
+def get_windows(sentences, max_chars=SEGMENTED_WINDOW_CHARS):
+    """
+    :return: [first, last) ranges of consecutive sentences, of up to max_chars each
+    """
+    windows, first = [], 0
+    for i in range(1, len(sentences)):
+        if sentences[i][1] - sentences[first][0] > max_chars:
+            windows.append((first, i))
+            first = i
+    windows.append((first, len(sentences)))
+    return windows
+
+
+def strip_slv_codes(result):
+    return SLV_INSERTED_CODE_PATTERN.sub("", result)
+
+
+def align_coded_window(window, coded_window):
+    """
+    :return: the coded window with the exact whitespace of the window (which the model might change),
+             every code right after its text with a space, or None if its words aren't exactly the window's
+    """
+    words = list(WORD_PATTERN.finditer(window))
+    parts, position, num_aligned_words, chunk_start = [], 0, 0, 0
+    for code in [*SLV_CODE_ONLY_PATTERN.finditer(coded_window), None]:
+        chunk_words = coded_window[chunk_start:code.start() if code else len(coded_window)].split()
+        window_words = words[num_aligned_words:num_aligned_words + len(chunk_words)]
+        if [word.group() for word in window_words] != chunk_words:
+            return None
+        if window_words:
+            parts.append(window[position:window_words[-1].end()])
+            position = window_words[-1].end()
+            num_aligned_words += len(window_words)
+        if code:
+            parts.append(f" {code.group()}")
+            chunk_start = code.end()
+    if num_aligned_words != len(words):
+        return None
+    parts.append(window[position:])
+    return "".join(parts)
+
+
+def get_window_context_message(memory, sentences, first):
+    """
+    :return: a system message with the beginning of the memory, and the sentences right before the window
+             that starts with sentence `first`, which are already coded in the previous windows
+    """
+    main_event_end = next((i for i, (_, end) in enumerate(sentences) if end >= SEGMENTED_MAIN_EVENT_CHARS),
+                          len(sentences) - 1) + 1
+    main_event_end = min(main_event_end, first)
+    overlap_start = max(main_event_end, first - SEGMENTED_OVERLAP_SENTENCES)
+    beginning = memory[:sentences[main_event_end - 1][1]]
+    previous = memory[sentences[overlap_start][0]:sentences[first - 1][1]] if overlap_start < first else ""
+    return {"role": "system", "content": SEGMENTED_CONTEXT_INSTRUCTION.format(beginning=beginning,
+                                                                              previous=previous or "(nothing)")}
+
+
+def code_segmented_memory(memory, message_history, use_cache=True, *, model_parameters, user=None,
+                          warning_callback=None, **kwargs):
+    """
+    Codes the memory's windows in parallel, in the process-wide window executor (see the module's docstring),
+    re-coding malformed windows (or ones whose words aren't exactly the window's) with some sampling
+    up to SEGMENTED_WINDOW_RETRIES times
+    :return: the stitched result, the messages of the whole memory and a generation log of all the windows
+    :raise MalformedResultError: if the stitched result without its codes isn't exactly the memory
+    """
+    _, service, base_llm, coding_task = model_parameters
+    sentences = split_sentences(memory)
+    windows = get_windows(sentences)
+
+    def code_window(window_index):
+        first, last = windows[window_index]
+        window = memory[sentences[first][0]:sentences[last - 1][1]]
+        window_history = message_history if first == 0 else \
+            message_history + [get_window_context_message(memory, sentences, first)]
+        window_kwargs = dict(kwargs)
+        for retry in range(SEGMENTED_WINDOW_RETRIES + 1):
+            if retry > 0:  # a different output than the cached one
+                window_kwargs[TEMPERATURE_PARAM] = max(kwargs.get(TEMPERATURE_PARAM, DEFAULT_TEMPERATURE),
+                                                       REGENERATION_TEMPERATURE)
+            result, _, log = code_text(window, window_history, use_cache, model_parameters=model_parameters,
+                                       user=user, warning_callback=warning_callback, **window_kwargs)
+            aligned_result = align_coded_window(window, result or "")
+            if aligned_result is not None and is_valid_coded_result(window, aligned_result, coding_task):
+                return aligned_result, log
+        return result, log
+
+    coded_windows = list(get_window_executor().map(code_window, range(len(windows))))
+
+    # the coded windows with the exact separators between them in the memory
+    result_parts = [memory[:sentences[0][0]]]
+    for window_index, ((first, _), (coded_window, _)) in enumerate(zip(windows, coded_windows)):
+        if window_index > 0:
+            result_parts.append(memory[sentences[first - 1][1]:sentences[first][0]])
+        result_parts.append(coded_window or "")
+    result_parts.append(memory[sentences[-1][1]:])
+    result = "".join(result_parts)
+    if strip_slv_codes(result) != memory or not is_valid_coded_result(memory, result, coding_task):
+        raise MalformedResultError(f"The stitched result of the memory's {len(windows)} parts "
+                                   f"doesn't match the memory: {result!r}")
+
+    window_logs = [log for _, log in coded_windows]
+    spans = [{**window_span, "window": window_index}
+             for window_index, log in enumerate(window_logs) for window_span in json.loads(log[SPANS_COLUMN] or "[]")]
+    usage = {PROMPT_TOKENS: 0, COMPLETION_TOKENS: 0}
+    for log in window_logs:
+        for tokens, count in json.loads(log[USAGE_COLUMN] or "{}").items():
+            usage[tokens] += count
+    routes = list({log[ROUTE_COLUMN]: None for log in window_logs if log[ROUTE_COLUMN]})
+    messages = message_history + [{"role": "user", "content": memory}]
+    log = get_generation_log(service, base_llm, coding_task, messages, window_logs[0][GEN_KWARGS_COLUMN], result,
+                             SEGMENTED_CODING_TASK, user, spans, usage)
+    if routes:  # none if all the windows were cached
+        log[ROUTE_COLUMN] = routes[0] if len(routes) == 1 else json.dumps([json.loads(route) for route in routes])
+    return result, messages, log
+
@@ -0,0 +1,26 @@
+import sqlite3
+
+from batch_jobs import BatchJobCheckpoint
+
+
+def test_checkpoint_results_in_row_order_across_pages(tmp_path):
+    checkpoint = BatchJobCheckpoint(str(tmp_path / "checkpoint.sqlite"))
+    for row_index in [7, 1, 3, 0, 9]:
+        checkpoint.save("job", row_index, f"result {row_index}")
+    checkpoint.save("other job", 2, "other result")
+    assert list(checkpoint.iter_results("job", page_size=2)) == \
+        [(row_index, f"result {row_index}") for row_index in [0, 1, 3, 7, 9]]
+    assert checkpoint.count("job") == 5
+    checkpoint.clear("job")
+    assert checkpoint.count("job") == 0 and checkpoint.count("other job") == 1
+
+
+def test_checkpoint_migrates_the_old_table(tmp_path):
+    path = str(tmp_path / "checkpoint.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE coded_rows (job_id TEXT, row_index INTEGER, memory TEXT, result TEXT, "
+                       "log TEXT, PRIMARY KEY (job_id, row_index))")
+    connection.execute("INSERT INTO coded_rows VALUES ('job', 0, 'memory', 'result', '{}')")
+    connection.commit()
+    connection.close()
+    assert list(BatchJobCheckpoint(path).iter_results("job")) == [(0, "result")]
@@ -0,0 +1,41 @@
+import numpy as np
+
+from coded_results import parse_slv_result, parse_coh_result, is_valid_coded_result, get_coh_scores, \
+    get_coh_scores_array, MALFORMED_COH_SCORES
+from constants import *
+
+
+def test_parse_slv_result_spans():
+    result = "We went home. _ext_neu_ It rained. _ext_neg_"
+    segments = parse_slv_result(result)
+    assert [(segment.text, segment.locus, segment.valence) for segment in segments] == \
+        [("We went home.", "ext", "neu"), ("It rained.", "ext", "neg")]
+    assert all(result[segment.start:segment.end] == segment.text for segment in segments)
+
+
+def test_parse_coh_result():
+    scores = parse_coh_result("Context: 1\nChronology: 2\nTheme: 3\nTotal: 7")
+    assert scores[:4] == (1, 2, 3, 7) and not scores.is_total_consistent
+    assert parse_coh_result("Context: 4\nChronology: 2\nTheme: 3\nTotal: 9") is None
+
+
+def test_is_valid_coded_result():
+    assert is_valid_coded_result("We went home.", "We went  home. _ext_neu_", SEGMENT_LOCUS_VALENCE)
+    assert not is_valid_coded_result("We went home.", "We went home.", SEGMENT_LOCUS_VALENCE)
+    assert not is_valid_coded_result("We went home.", "We went. _ext_neu_", SEGMENT_LOCUS_VALENCE)
+    assert is_valid_coded_result("", "Context: 1\nChronology: 2\nTheme: 3\nTotal: 6", NARRATIVE_COHERENCE)
+    assert not is_valid_coded_result("", "Context: 1\nChronology: 2\nTheme: 3\nTotal: 7", NARRATIVE_COHERENCE)
+    assert not is_valid_coded_result("", None, NARRATIVE_COHERENCE)
+
+
+def test_get_coh_scores_computes_the_total():
+    assert get_coh_scores("Context: 1\nChronology: 2\nTheme: 3\nTotal: 7") == (1, 2, 3, 6)
+    assert get_coh_scores("no scores") == MALFORMED_COH_SCORES
+    assert get_coh_scores(None) == MALFORMED_COH_SCORES
+
+
+def test_get_coh_scores_array():
+    array = get_coh_scores_array(["Context: 0\nChronology: 0\nTheme: 1\nTotal: 1", ""])
+    assert array.dtype == np.int8
+    assert array.tolist() == [[0, 0, 1, 1], list(MALFORMED_COH_SCORES)]
+    assert get_coh_scores_array([]).shape == (0, 4)
@@ -0,0 +1,45 @@
+import csv
+import random
+
+import numpy as np
+
+from exporting import OrderedResultsWriter, RESULTS_WRITERS, create_results_writer
+from constants import *
+
+
+def read_csv_rows(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.reader(f))[1:]
+
+
+def test_ordered_results_writer_writes_in_order(tmp_path):
+    writer = OrderedResultsWriter(RESULTS_WRITERS["CSV"](str(tmp_path / "results.csv"), SEGMENT_LOCUS_VALENCE))
+    for row_index in [2, 0, 1, 4, 3]:
+        writer.write(row_index, f"memory {row_index}", f"result {row_index}")
+    writer.finish([], [], 5)
+    assert read_csv_rows(tmp_path / "results.csv") == [[f"memory {i}", f"result {i}"] for i in range(5)]
+
+
+def test_ordered_results_writer_spills_and_finishes_the_failed_rows(tmp_path):
+    writer = OrderedResultsWriter(RESULTS_WRITERS["CSV"](str(tmp_path / "results.csv"), SEGMENT_LOCUS_VALENCE),
+                                  max_pending_rows=3)
+    row_indices = list(range(50))
+    random.Random(0).shuffle(row_indices)
+    for row_index in row_indices:
+        if row_index != 5:  # failed
+            writer.write(row_index, f"memory {row_index}", f"result {row_index}")
+    assert len(writer.pending_rows) <= 3 and writer.num_spilled_rows > 0
+    writer.finish({5: "memory 5"}, {5: None}, 50)
+    assert read_csv_rows(tmp_path / "results.csv") == \
+        [[f"memory {i}", "" if i == 5 else f"result {i}"] for i in range(50)]
+
+
+def test_npy_scores_writer(tmp_path):
+    path = str(tmp_path / "scores.npy")
+    writer = create_results_writer("NumPy scores", NARRATIVE_COHERENCE, path)
+    writer.write(1, "memory", "malformed")
+    writer.write(0, "memory", "Context: 1\nChronology: 2\nTheme: 3\nTotal: 6")
+    writer.finish([], [], 2)
+    array = np.load(path)
+    assert array.dtype == np.int8
+    assert array.tolist() == [[1, 2, 3, 6], [-1, -1, -1, -1]]
@@ -0,0 +1,15 @@
+from packed_coding import split_packed_output
+
+
+def test_split_packed_output_by_number():
+    output = "### RESULT 2\nsecond\n### END 2\n### RESULT 1\nfirst\nline\n### END 1\n"
+    assert split_packed_output(output, 3) == ["first\nline", "second", None]
+
+
+def test_split_packed_output_ignores_unknown_and_repeated_results():
+    output = "### RESULT 1\nfirst\n### END 1\n### RESULT 1\nagain\n### END 1\n### RESULT 5\nfifth\n### END 5"
+    assert split_packed_output(output, 2) == ["first", None]
+
+
+def test_split_packed_output_ignores_unclosed_results():
+    assert split_packed_output("### RESULT 1\nfirst\n### END 2", 1) == [None]
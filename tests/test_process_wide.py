@@ -0,0 +1,22 @@
+from process_wide import process_wide
+
+
+def test_one_instance_per_key():
+    @process_wide(key=lambda name, options: name)
+    def get_named(name, options):
+        return [name, options]
+
+    assert get_named("a", 1) is get_named("a", 2)
+    assert get_named("a", 1) is not get_named("b", 1)
+    assert get_named.get("a") == ["a", 1] and get_named.get("c") is None
+    assert set(get_named.get_instances()) == {"a", "b"}
+
+
+def test_replace_returns_the_previous_instance():
+    @process_wide
+    def get_instance():
+        return object()
+
+    previous_instance = get_instance()
+    assert get_instance.replace((), "replacement") is previous_instance
+    assert get_instance() == "replacement"
@@ -0,0 +1,29 @@
+import time
+
+from scheduling import TokenBucket
+
+
+def test_token_bucket_allows_a_burst_of_its_capacity():
+    bucket = TokenBucket(rate_per_minute=60, capacity=10)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.acquire(1)
+    assert time.monotonic() - start < 0.5
+
+
+def test_token_bucket_waits_for_the_rate():
+    bucket = TokenBucket(rate_per_minute=600, capacity=1)  # 10 per second
+    bucket.acquire(1)
+    start = time.monotonic()
+    bucket.acquire(1)
+    assert time.monotonic() - start >= 0.05
+
+
+def test_token_bucket_release_gives_back_up_to_its_capacity():
+    bucket = TokenBucket(rate_per_minute=60, capacity=10)
+    bucket.acquire(10)
+    bucket.release(100)
+    assert bucket.available <= 10
+    start = time.monotonic()
+    bucket.acquire(10)
+    assert time.monotonic() - start < 0.5
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import pytest
+
+from segmented_coding import split_sentences, get_windows, strip_slv_codes, align_coded_window, code_segmented_memory
+from constants import *
+
+MEMORY = "\n  ".join(f'It was day {i} of the trip.  "Why?" she asked (twice).\nWe laughed!' for i in range(40)) + "\n"
+
+
+def test_split_sentences_keeps_closing_quotes_and_brackets():
+    memory = 'He said "go." Then (we went.) And stayed'
+    assert [memory[start:end] for start, end in split_sentences(memory)] == \
+        ['He said "go."', "Then (we went.)", "And stayed"]
+
+
+def test_split_sentences_splits_long_sentences_at_whitespace():
+    memory = " ".join(["word"] * 100)
+    sentences = split_sentences(memory, max_chars=50)
+    assert all(end - start <= 50 for start, end in sentences)
+    assert " ".join(memory[start:end] for start, end in sentences) == memory
+
+
+def test_get_windows_covers_all_sentences_within_max_chars():
+    sentences = split_sentences(MEMORY)
+    windows = get_windows(sentences, max_chars=300)
+    assert windows[0][0] == 0 and windows[-1][1] == len(sentences)
+    assert all(previous[1] == following[0] for previous, following in zip(windows, windows[1:]))
+    assert all(sentences[last - 1][1] - sentences[first][0] <= 300 for first, last in windows if last - first > 1)
+
+
+def test_align_coded_window_restores_the_whitespace():
+    window = "We went home.\n\n  It  rained."
+    aligned = align_coded_window(window, "We went home. _ext_neu_ It rained. _ext_neg_")
+    assert aligned == "We went home. _ext_neu_\n\n  It  rained. _ext_neg_"
+    assert strip_slv_codes(aligned) == window
+
+
+@pytest.mark.parametrize("coded_window", ["We went home. _ext_neu_", "We went far home. _ext_neu_ It rained. _ext_neg_"])
+def test_align_coded_window_rejects_other_words(coded_window):
+    assert align_coded_window("We went home. It rained.", coded_window) is None
+
+
+class FakeClient:
+    """
+    Codes every sentence of its input, collapsing the whitespace between them like the models sometimes do
+    """
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=self)
+        self.inputs = []
+
+    def create(self, model, messages, **kwargs):
+        window = messages[-1]["content"]
+        self.inputs.append(window)
+        coded = " ".join(f"{window[start:end]} _int_neu_" for start, end in split_sentences(window))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=coded), finish_reason="stop")],
+                               usage=SimpleNamespace(completion_tokens=10, prompt_tokens=10))
+
+
+def test_code_segmented_memory_stitches_the_exact_memory():
+    client = FakeClient()
+    result, _, log = code_segmented_memory(MEMORY, [{"role": "system", "content": "Code it"}], use_cache=False,
+                                           model_parameters=(client, FREE_SERVICE, "model", SEGMENT_LOCUS_VALENCE),
+                                           temperature=0)
+    assert len(client.inputs) > 1
+    assert strip_slv_codes(result) == MEMORY
+    assert result.count("_int_neu_") == len(split_sentences(MEMORY))
+    assert log[TASK_COLUMN] == SEGMENTED_CODING_TASK
@@ -0,0 +1,77 @@
+import os
+import json
+import math
+import sqlite3
+import threading
+from collections import defaultdict, deque
+from generation_logging import get_default_log_sink_type
+from process_wide import process_wide
+from constants import *
+
+
+class TokenBudgetPolicy:
+    """
+    Learns how many completion tokens each (base LLM, coding task) usually needs,
+    and picks max_tokens from a high percentile of it instead of a fixed default
+    """
+    def __init__(self, window=TOKEN_BUDGET_WINDOW, percentile=TOKEN_BUDGET_PERCENTILE,
+                 margin=TOKEN_BUDGET_MARGIN):
+        self.percentile = percentile
+        self.margin = margin
+        self.observations = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def record(self, base_llm, coding_task, completion_tokens):
+        if completion_tokens:
+            with self.lock:
+                self.observations[(base_llm, coding_task)].append(completion_tokens)
+
+    def get_initial_max_tokens(self, base_llm, coding_task, default=MAX_TOKENS_DEFAULT):
+        with self.lock:
+            observations = sorted(self.observations.get((base_llm, coding_task), ()))
+        if len(observations) < TOKEN_BUDGET_MIN_OBSERVATIONS:
+            return default
+        high_percentile = observations[min(len(observations) - 1,
+                                           math.ceil(self.percentile / 100 * len(observations)) - 1)]
+        return max(TOKEN_BUDGET_MIN_MAX_TOKENS,
+                   min(int(high_percentile * (1 + self.margin)), TOKEN_BUDGET_MAX_MAX_TOKENS))
+
+    @staticmethod
+    def grow(max_tokens):
+        return min(int(max_tokens * TOKEN_BUDGET_GROWTH_FACTOR), TOKEN_BUDGET_MAX_MAX_TOKENS)
+
+    def load_generation_logs(self, logs):
+        """
+        Seeds the statistics from the completion tokens reported in past generation logs, as record does
+        (the output's length would miss the thinking tokens, so logs without usage, e.g. cached outputs, are skipped)
+        """
+        for log in logs:
+            if log.get(TASK_COLUMN) != DIRECT_CODING_TASK or not log.get(OUTPUT_COLUMN) or not log.get(USAGE_COLUMN):
+                continue
+            route = json.loads(log[ROUTE_COLUMN]) if log.get(ROUTE_COLUMN) else {}
+            if route.get(BASE_LLM_COLUMN, log.get(BASE_LLM_COLUMN)) == log.get(BASE_LLM_COLUMN):
+                self.record(log.get(BASE_LLM_COLUMN), log.get(CODING_TASK_COLUMN),
+                            json.loads(log[USAGE_COLUMN]).get(COMPLETION_TOKENS))
+
+
+def read_local_generation_logs():
+    # only the local sinks are read, reading the whole google sheet is what we want to avoid
+    sink_type = get_default_log_sink_type()
+    if sink_type == JSONL_LOG_SINK and os.path.exists(LOCAL_GENERATION_LOG_JSONL_PATH):
+        with open(LOCAL_GENERATION_LOG_JSONL_PATH, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    if sink_type == SQLITE_LOG_SINK and os.path.exists(LOCAL_GENERATION_LOG_SQLITE_PATH):
+        connection = sqlite3.connect(LOCAL_GENERATION_LOG_SQLITE_PATH)
+        try:
+            connection.row_factory = sqlite3.Row
+            return [dict(row) for row in connection.execute("SELECT * FROM generation_log")]
+        finally:
+            connection.close()
+    return []
+
+
+@process_wide
+def get_token_budget_policy():
+    policy = TokenBudgetPolicy()
+    policy.load_generation_logs(read_local_generation_logs())
+    return policy